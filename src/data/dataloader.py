@@ -1,13 +1,159 @@
+import glob
+import hashlib
+import io
 import json
 import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import wraps
 
+import numpy as np
 import pandas as pd
 
+from src.utils import data_utils
 from src.utils.data_utils import *
 
+# Bump when the on-disk cache layout changes so old cache files are ignored
+CACHE_VERSION = 1
+
+# Code whose changes must invalidate cached tables
+LOADER_SOURCES = [os.path.abspath(__file__), os.path.abspath(data_utils.__file__)]
+
+# Columns read from each source file with their types, in file order
+SCHEMAS = {
+    "character": {
+        "Wikipedia movie ID": "int64",
+        "Freebase movie ID": str,
+        "Character name": str,
+        "Actor date of birth": str,
+        "Actor gender": str,
+        "Actor height (in meters)": "float64",
+        "Actor ethnicity (Freebase ID)": str,
+        "Actor name": str,
+        "Actor age at movie release": "float64",
+        "Freebase character ID": str,
+        "Freebase actor ID": str,
+    },
+    "movie": {
+        "Wikipedia movie ID": "int64",
+        "Freebase movie ID": str,
+        "Movie name": str,
+        "Movie release date": str,
+        "Movie box office revenue": "float64",
+        "Movie languages (Freebase ID:name tuples)": str,
+        "Movie countries (Freebase ID:name tuples)": str,
+        "Movie genres (Freebase ID:name tuples)": str,
+    },
+    "name": {"Character name": str, "Freebase character/actor map ID": str},
+    "plot": {"wikipedia_movie_id": "int64", "plot": str},
+    "tvtropes": {"trope": str, "details": str},
+    "fb_wiki": {"freebase_id": str, "wikidata_id": str, "label": str},
+    "tmdb_movies": {"title": str, "release_date": str, "revenue": "float64"},
+}
+
+# Rows per chunk when streaming the character metadata
+DEFAULT_CHUNKSIZE = 100_000
+
+# Columns of the joined movies and characters table, aggregated per movie
+MOVIE_COLUMNS = [
+    "wikidata_movie_id",
+    "Movie name",
+    "Movie release date",
+    "Movie box office revenue",
+    "Movie languages",
+    "Movie countries",
+    "Movie genres",
+]
+CAST_COLUMNS = [
+    "character_name",
+    "actor_gender",
+    "actor_height_meters",
+    "actor_age_at_release",
+    "ethnicity",
+]
+
+
+# Tables of the DataLoader dependency graph, registered by `cached_table`
+TABLES = {}
+
+
+def cached_table(
+    name: str,
+    inputs: list = (),
+    sources: list = (),
+    persist: bool = False,
+    whole_inputs: list = (),
+):
+    """Declare a loader method as a table of the DataLoader dependency graph.
+
+    The decorated method receives the tables listed in `inputs` as keyword
+    arguments and reads the `sources` files (keys of `DataLoader.paths`) itself.
+    It must not modify its input tables, which are shared. Tables are built
+    lazily when first requested and memoized for the DataLoader session, so a
+    table needed by several others is built once.
+
+    The tables in `whole_inputs` are only built and passed when the loader does
+    not stream the character metadata in chunks, and are None otherwise.
+
+    Tables with `persist` are also cached as Parquet in `cache_dir`. The cache key
+    is built from the fingerprint of the source files of the table and of all its
+    inputs and of the loader code itself, so any change to an input file or to
+    the processing rebuilds the table.
+    """
+
+    def decorator(build):
+        TABLES[name] = {
+            "build": build,
+            "inputs": list(inputs),
+            "sources": list(sources),
+            "persist": persist,
+            "whole_inputs": list(whole_inputs),
+        }
+
+        @wraps(build)
+        def wrapper(self):
+            return self.load(name)
+
+        return wrapper
+
+    return decorator
+
 
 class DataLoader:
-    def __init__(self):
+    def __init__(
+        self,
+        cache_dir: str = None,
+        hash_sources: bool = False,
+        copy_on_return: bool = True,
+        engine: str = None,
+        chunksize: int = None,
+        workers: int = None,
+    ):
+        """
+        Tables are built lazily from the tables they depend on (see `TABLES`) and
+        memoized for the lifetime of the loader, so tables shared by several others
+        are only built once. Use `invalidate` to reload them.
+
+        Parameters:
+        ----------
+        cache_dir : Directory where processed tables are cached as Parquet files.
+            Caching is disabled when None.
+        hash_sources : Also hash the content of the source files for the cache key
+            instead of relying on their size and modification time only.
+        copy_on_return : Return copies of the memoized tables so callers cannot
+            modify the shared versions. Disable to avoid the copy when the returned
+            tables are only read.
+        engine : Parser engine used by `pd.read_csv` (e.g. "pyarrow"). Defaults to
+            pandas' C parser, or to pyarrow when loading in parallel. The TMDB file,
+            which has malformed rows, is always read with the C parser.
+        chunksize : Stream the character metadata in chunks of this many rows when
+            building the joined movies and characters table, so its memory use is
+            bounded by the chunk size instead of the file size.
+        workers : Build the tables a requested table depends on concurrently on this
+            many threads, each one as soon as its inputs are built, so the
+            independent source files are parsed at the same time. The pyarrow
+            parser releases the GIL, so the reads overlap. Tables are built one
+            after another when None.
+        """
         current_dir = os.path.dirname(os.path.abspath(__file__))
         data_dir = os.path.join(
             os.path.dirname(os.path.dirname(current_dir)), "datasets"
@@ -21,63 +167,319 @@ class DataLoader:
             "fb_wiki": os.path.join(data_dir, "freebase_wikidata_mapping.tsv"),
             "tmdb_movies": os.path.join(data_dir, "tmdb/movies_metadata.csv"),
         }
+        self.cache_dir = cache_dir
+        self.hash_sources = hash_sources
+        self.copy_on_return = copy_on_return
+        self.engine = "pyarrow" if engine is None and workers else engine
+        self.chunksize = chunksize
+        self.workers = workers
+        self._tables = {}
+        # Content hashes of the source files by path, size and modification time
+        self._digests = {}
+
+    @property
+    def tmdb_matches(self) -> dict:
+        """
+        Statistics of the TMDB enrichment of the movies table: the numbers of matched movies
+        and of matched movies whose title had several TMDB entries. They are stored with the
+        table, so they are also available when it is read from the cache, and are None
+        until the movies table is loaded.
+        """
+        movies = self._tables.get("movies")
+        return None if movies is None else movies.attrs.get("tmdb_matches")
+
+    def load(self, name: str) -> pd.DataFrame:
+        """Load a table by name, building only the tables it depends on"""
+        if self.workers:
+            self._prefetch(name)
+        df = self._table(name)
+        return df.copy() if self.copy_on_return else df
+
+    def invalidate(self, *names: str):
+        """Forget the memoized tables with the given names and the tables built from
+        them, or all the tables"""
+        if not names:
+            self._tables.clear()
+        for table in list(self._tables):
+            if table in names or set(names) & set(self.dependencies(table)):
+                self._tables.pop(table)
+
+    def dependencies(self, name: str) -> list:
+        """All the tables a table is built from, each one listed before its dependents"""
+        tables = []
+        for input_name in self._inputs(name):
+            for table in self.dependencies(input_name) + [input_name]:
+                if table not in tables:
+                    tables.append(table)
+        return tables
+
+    def sources(self, name: str) -> list:
+        """All the source files (keys of `paths`) a table is built from"""
+        sources = []
+        for table in self.dependencies(name) + [name]:
+            for source in TABLES[table]["sources"]:
+                if source not in sources:
+                    sources.append(source)
+        return sources
+
+    def _inputs(self, name: str) -> list:
+        """The input tables of a table with the current streaming setting"""
+        table = TABLES[name]
+        if self.chunksize is None:
+            return table["inputs"] + table["whole_inputs"]
+        return table["inputs"]
+
+    def _is_cached(self, name: str) -> bool:
+        """Whether a table has an up-to-date file in the Parquet cache"""
+        return (
+            self.cache_dir is not None
+            and TABLES[name]["persist"]
+            and os.path.exists(self._cache_path(name))
+        )
 
-    def _load_tsv(self, path: str, names: list = None) -> pd.DataFrame:
-        """Generic TSV loader"""
-        return pd.read_csv(path, sep="\t", names=names)
+    def _prefetch(self, name: str):
+        """Build the missing tables a table depends on on the thread pool. Tables
+        with an up-to-date cache file are read from it, without their inputs."""
+        pending, cached = [], set()
+
+        def visit(table):
+            if table in self._tables or table in pending:
+                return
+            if self._is_cached(table):
+                cached.add(table)
+            else:
+                for input_name in self._inputs(table):
+                    visit(input_name)
+            pending.append(table)
+
+        visit(name)
+        # The requested table itself is loaded by `load`
+        pending = [table for table in pending if table != name]
+        running = {}
+        with ThreadPoolExecutor(self.workers) as executor:
+            while pending or running:
+                # Start every table that is cached or whose inputs are all built
+                for table in list(pending):
+                    inputs = self._inputs(table)
+                    if table in cached or all(
+                        input_name in self._tables for input_name in inputs
+                    ):
+                        pending.remove(table)
+                        running[executor.submit(self._load_cached, table)] = table
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._tables[running.pop(future)] = future.result()
+
+    def _table(self, name: str) -> pd.DataFrame:
+        """Get the shared memoized version of a table, building it if needed"""
+        if name not in self._tables:
+            self._tables[name] = self._load_cached(name)
+        return self._tables[name]
+
+    def _build(self, name: str) -> pd.DataFrame:
+        """Build a table from its input tables"""
+        table = TABLES[name]
+        inputs = dict.fromkeys(table["whole_inputs"])
+        inputs.update(
+            {input_name: self._table(input_name) for input_name in self._inputs(name)}
+        )
+        return table["build"](self, **inputs)
 
-    def load_characters(self) -> pd.DataFrame:
-        """Load character metadata"""
-        df = self._load_tsv(self.paths["character"])
+    def _load_cached(self, name: str) -> pd.DataFrame:
+        """Load a table from the Parquet cache, building and caching it if needed"""
+        if self.cache_dir is None or not TABLES[name]["persist"]:
+            return self._build(name)
 
-        # Drop "Movie release date" column
-        df.drop(
-            columns=["Movie release date", "Freebase character/actor map ID"],
-            inplace=True,
-        )
+        path = self._cache_path(name)
+        if os.path.exists(path):
+            return pd.read_parquet(path)
 
-        # Get mapping once
-        fb_wiki_mapping = self.load_fb_wiki_mapping()
+        df = self._build(name)
+        self._write_cache(name, path, df)
+        return df
 
-        # Map ethnicity
-        df = df.merge(
-            fb_wiki_mapping[["freebase_id", "label"]],
-            how="left",
-            left_on="Actor ethnicity (Freebase ID)",
-            right_on="freebase_id",
+    def _fingerprint(self, path: str) -> list:
+        """
+        Identify a file by its path, size and modification time (and content hash).
+        The content of each version of a file is only hashed once per loader.
+        """
+        stat = os.stat(path)
+        fingerprint = [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+        if self.hash_sources:
+            key = tuple(fingerprint)
+            if key not in self._digests:
+                digest = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for block in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(block)
+                self._digests[key] = digest.hexdigest()
+            fingerprint.append(self._digests[key])
+        return fingerprint
+
+    def _cache_path(self, name: str) -> str:
+        """Path of the cache file of a table for the current state of its sources"""
+        files = [self.paths[source] for source in self.sources(name)] + LOADER_SOURCES
+        key = json.dumps(
+            [CACHE_VERSION] + [self._fingerprint(path) for path in files]
         )
-        df.drop(columns=["freebase_id", "Actor ethnicity (Freebase ID)"], inplace=True)
-        df.rename(columns={"label": "ethnicity"}, inplace=True)
-
-        # Map character ID
-        df = df.merge(
-            fb_wiki_mapping[["freebase_id", "wikidata_id"]],
-            how="left",
-            left_on="Freebase character ID",
-            right_on="freebase_id",
+        digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{name}-{digest}.parquet")
+
+    def _write_cache(self, name: str, path: str, df: pd.DataFrame):
+        """Atomically write a table to the cache and remove its stale versions"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for stale in glob.glob(os.path.join(self.cache_dir, f"{name}-*.parquet")):
+            os.remove(stale)
+        tmp_path = f"{path}.tmp"
+        df.to_parquet(tmp_path)
+        os.replace(tmp_path, path)
+
+    def _read_csv(
+        self, path: str, dtype: dict = None, engine: str = None, **kwargs
+    ) -> pd.DataFrame:
+        """
+        Read a CSV file with the configured engine (or `engine`), keeping only the
+        columns in `dtype`
+        """
+        engine = engine or self.engine
+        # pyarrow cannot read files in chunks
+        if kwargs.get("chunksize") is not None:
+            engine = None
+        if dtype is None:
+            return pd.read_csv(path, engine=engine, **kwargs)
+        if kwargs.get("names") is None:
+            kwargs["usecols"] = list(dtype)
+        if engine != "pyarrow":
+            return pd.read_csv(path, dtype=dtype, engine=engine, **kwargs)
+
+        # pyarrow turns missing values of `str` columns into "None", so read them as
+        # Arrow strings and convert them to the object columns the C parser returns
+        text_columns = [col for col, col_type in dtype.items() if col_type is str]
+        arrow_dtype = {
+            col: "string[pyarrow]" if col in text_columns else col_type
+            for col, col_type in dtype.items()
+        }
+        df = pd.read_csv(path, dtype=arrow_dtype, engine=engine, **kwargs)
+        for col in text_columns:
+            df[col] = df[col].to_numpy(dtype=object, na_value=np.nan)
+        return df
+
+    def _load_tsv(
+        self, path: str, names: list = None, dtype: dict = None, **kwargs
+    ) -> pd.DataFrame:
+        """Generic TSV loader"""
+        return self._read_csv(path, sep="\t", names=names, dtype=dtype, **kwargs)
+
+    @cached_table("raw_characters", sources=["character"])
+    def load_raw_characters(self) -> pd.DataFrame:
+        """Load character metadata as stored in the source file"""
+        # "Movie release date" and "Freebase character/actor map ID" are not read
+        return self._load_tsv(self.paths["character"], dtype=SCHEMAS["character"])
+
+    @cached_table(
+        "characters",
+        inputs=["raw_characters", "fb_wiki_index", "movies"],
+        persist=True,
+    )
+    def load_characters(
+        self,
+        raw_characters: pd.DataFrame,
+        fb_wiki_index: pd.DataFrame,
+        movies: pd.DataFrame,
+    ) -> pd.DataFrame:
+        """Load character metadata"""
+        df = self._clean_characters(
+            raw_characters,
+            fb_wiki_index,
+            movies[["wikipedia_movie_id", "Movie release date"]],
         )
-        df.drop(columns=["freebase_id", "Freebase character ID"], inplace=True)
-        df.rename(columns={"wikidata_id": "wikidata_character_id"}, inplace=True)
-
-        # Map actor ID
-        df = df.merge(
-            fb_wiki_mapping[["freebase_id", "wikidata_id"]],
-            how="left",
-            left_on="Freebase actor ID",
-            right_on="freebase_id",
+
+        # Add this in case we want to use the 500 TV tropes
+        # df = pd.merge(
+        #     df,
+        #     self.load_tvtropes()[["trope", "Freebase character/actor map ID"]],
+        #     on="Freebase character/actor map ID",
+        #     how="left",
+        # )
+
+        return df
+
+    def iter_characters(self, chunksize: int = None):
+        """Load character metadata as a stream of cleaned chunks of `chunksize` rows"""
+        return self._iter_characters(
+            self._table("fb_wiki_index"), self._table("movies"), chunksize
         )
-        df.drop(columns=["freebase_id", "Freebase actor ID"], inplace=True)
-        df.rename(columns={"wikidata_id": "wikidata_actor_id"}, inplace=True)
-
-        # Map Freebase movie ID
-        df = df.merge(
-            fb_wiki_mapping[["freebase_id", "wikidata_id"]],
-            how="left",
-            left_on="Freebase movie ID",
-            right_on="freebase_id",
+
+    def _iter_characters(
+        self, fb_wiki_index: pd.DataFrame, movies: pd.DataFrame, chunksize: int = None
+    ):
+        movies_df = movies[["wikipedia_movie_id", "Movie release date"]]
+        chunks = self._load_tsv(
+            self.paths["character"],
+            dtype=SCHEMAS["character"],
+            chunksize=chunksize or self.chunksize or DEFAULT_CHUNKSIZE,
         )
-        df.drop(columns=["freebase_id", "Freebase movie ID"], inplace=True)
-        df.rename(columns={"wikidata_id": "wikidata_movie_id"}, inplace=True)
+        for chunk in chunks:
+            yield self._clean_characters(chunk, fb_wiki_index, movies_df)
+
+    def write_characters(self, path: str, chunksize: int = None) -> str:
+        """Write the cleaned character metadata to a Parquet file chunk by chunk"""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for chunk in self.iter_characters(chunksize):
+                if writer is None:
+                    # Columns that are empty in the first chunk hold strings
+                    schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                    schema = pa.schema(
+                        field.with_type(pa.string()) if field.type == pa.null() else field
+                        for field in schema
+                    )
+                    writer = pq.ParquetWriter(path, schema)
+                writer.write_table(
+                    pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+                )
+        finally:
+            if writer is not None:
+                writer.close()
+        return path
+
+    def _clean_characters(
+        self, df: pd.DataFrame, fb_wiki_index: pd.DataFrame, movies_df: pd.DataFrame
+    ) -> pd.DataFrame:
+        """Map the Freebase IDs of raw character metadata and clean the actor ages"""
+        # Resolve the ethnicity, character, actor and movie Freebase IDs against
+        # the mapping index at once instead of merging the full mapping four times,
+        # when each Freebase ID has a single entry in the mapping
+        freebase_columns = {
+            "Actor ethnicity (Freebase ID)": ("label", "ethnicity"),
+            "Freebase character ID": ("wikidata_id", "wikidata_character_id"),
+            "Freebase actor ID": ("wikidata_id", "wikidata_actor_id"),
+            "Freebase movie ID": ("wikidata_id", "wikidata_movie_id"),
+        }
+        if fb_wiki_index.index.is_unique:
+            mapped = {}
+            for freebase_column, (mapped_column, new_column) in freebase_columns.items():
+                positions = fb_wiki_index.index.get_indexer(df[freebase_column])
+                mapped[new_column] = pd.api.extensions.take(
+                    fb_wiki_index[mapped_column].to_numpy(), positions, allow_fill=True
+                )
+            # `df` may be a shared table, so build a new frame instead of modifying it
+            df = df.drop(columns=list(freebase_columns)).assign(**mapped)
+        else:
+            # A Freebase ID with several entries in the mapping repeats the rows that
+            # have it, once per entry, so the IDs are resolved by merges
+            fb_wiki = fb_wiki_index.reset_index()
+            for freebase_column, (mapped_column, new_column) in freebase_columns.items():
+                df = df.merge(
+                    fb_wiki[["freebase_id", mapped_column]].rename(
+                        columns={"freebase_id": freebase_column, mapped_column: new_column}
+                    ),
+                    how="left",
+                    on=freebase_column,
+                ).drop(columns=[freebase_column])
 
         # Rename columns with underscores
         df.rename(
@@ -98,7 +500,6 @@ class DataLoader:
 
         def clean_actor_age(df: pd.DataFrame):
             # Merge with movies to get release dates
-            movies_df = self.load_movies()[["wikipedia_movie_id", "Movie release date"]]
             df = pd.merge(df, movies_df, on="wikipedia_movie_id")
 
             # Extract birth year and movie release year
@@ -135,21 +536,13 @@ class DataLoader:
 
             return df
 
-        df = clean_actor_age(df)
-
-        # Add this in case we want to use the 500 TV tropes
-        # df = pd.merge(
-        #     df,
-        #     self.load_tvtropes()[["trope", "Freebase character/actor map ID"]],
-        #     on="Freebase character/actor map ID",
-        #     how="left",
-        # )
+        return clean_actor_age(df)
 
-        return df
-
-    def load_movies(self) -> pd.DataFrame:
-        """Load and process movie metadata"""
-        df = self._load_tsv(self.paths["movie"])
+    @cached_table("raw_movies", sources=["movie"])
+    def load_raw_movies(self) -> pd.DataFrame:
+        """Load movie metadata with the JSON columns decoded"""
+        # "Movie runtime" is not read
+        df = self._load_tsv(self.paths["movie"], dtype=SCHEMAS["movie"])
 
         # Process JSON columns
         json_columns = {
@@ -161,27 +554,50 @@ class DataLoader:
         for old_col, new_col in json_columns.items():
             # Convert JSON string of {id: name} pairs into comma-separated string of names
             # e.g. '{"m/123": "Action", "m/456": "Drama"}' -> "Action, Drama"
-            df[new_col] = df[old_col].apply(
-                lambda x: ", ".join(json.loads(x).values()) if pd.notnull(x) else x
-            )
+            _, names, offsets = decode_json_dict_column(df[old_col])
+            df[new_col] = join_ragged(names, offsets)
+            df.loc[df[old_col].isna(), new_col] = None
             df.drop(columns=[old_col], inplace=True)
 
         df.rename(columns={"Wikipedia movie ID": "wikipedia_movie_id"}, inplace=True)
+        return df
 
-        # Add TMDB release dates and revenue for movies with missing data
-        tmdb_df = pd.read_csv(self.paths["tmdb_movies"])
-        tmdb_df = tmdb_df[["title", "release_date", "revenue"]]
-        tmdb_df["release_date"] = tmdb_df["release_date"].str[:4]  # Keep only year
+    @cached_table("tmdb_movies", sources=["tmdb_movies"])
+    def load_tmdb_movies(self) -> pd.DataFrame:
+        """Load TMDB titles, release years and revenues"""
+        # The file has malformed short rows, which the C parser pads with missing
+        # values where pyarrow fails, so it is read with the C parser whatever the
+        # configured engine
+        df = self._read_csv(
+            self.paths["tmdb_movies"], dtype=SCHEMAS["tmdb_movies"], engine="c"
+        )
+        df["release_date"] = df["release_date"].str[:4]  # Keep only year
+        return df
 
-        # Merge with TMDB data
-        df = df.merge(tmdb_df, left_on="Movie name", right_on="title", how="left")
+    @cached_table("movies", inputs=["raw_movies", "tmdb_movies"], persist=True)
+    def load_movies(
+        self, raw_movies: pd.DataFrame, tmdb_movies: pd.DataFrame
+    ) -> pd.DataFrame:
+        """Load and process movie metadata"""
+        df = raw_movies.copy()
+
+        # Add TMDB release dates and revenue for movies with missing data,
+        # matching each movie with at most one TMDB entry
+        matches, df.attrs["tmdb_matches"] = self._match_tmdb(df, tmdb_movies)
+        release_dates, revenues = (
+            pd.api.extensions.take(
+                tmdb_movies[col].to_numpy(), matches, allow_fill=True
+            )
+            for col in ["release_date", "revenue"]
+        )
 
         # Fill missing dates and revenue with TMDB data
-        df["Movie release date"] = df["Movie release date"].fillna(df["release_date"])
+        df["Movie release date"] = df["Movie release date"].fillna(
+            pd.Series(release_dates, index=df.index)
+        )
         df["Movie box office revenue"] = df["Movie box office revenue"].fillna(
-            df["revenue"]
+            pd.Series(revenues, index=df.index)
         )
-        df.drop(columns=["title", "release_date", "revenue"], inplace=True)
 
         # Keep only the year from the release date
         # e.g. "2024-01-01" -> "2024"
@@ -196,86 +612,155 @@ class DataLoader:
             & (pd.to_numeric(df["Movie release date"], errors="coerce") <= 2012)
         ]
 
-        # Drop movie runtime column
-        df.drop(columns=["Movie runtime"], inplace=True)
-
         return df
 
-    def load_movies_with_characters(self) -> pd.DataFrame:
-        """Load movies with characters"""
-        df = self.load_movies()
-        df = df.merge(
-            self.load_characters(),
-            on="wikipedia_movie_id",
-            how="inner",
+    @staticmethod
+    def _match_tmdb(df: pd.DataFrame, tmdb_df: pd.DataFrame) -> tuple:
+        """
+        Find the position in `tmdb_df` of the TMDB entry of each movie, or -1 when there is none.
+
+        A movie matches the TMDB entry with the same normalized title and release year. A movie
+        whose release date is unknown matches the first TMDB entry with the same title, but a
+        dated movie never matches an entry of another year (e.g. a remake).
+
+        Returns the positions and the statistics of `tmdb_matches`.
+        """
+        movie_titles = normalize_title(df["Movie name"])
+        tmdb_titles = normalize_title(tmdb_df["title"])
+
+        matches = first_match(
+            movie_titles + "|" + df["Movie release date"].str[:4],
+            tmdb_titles + "|" + tmdb_df["release_date"],
         )
+        undated = df["Movie release date"].isna().to_numpy()
+        matches[undated] = first_match(movie_titles[undated], tmdb_titles)
 
-        df = (
-            df.groupby(["wikipedia_movie_id"])
-            .agg(
-                {
-                    "wikidata_movie_id": lambda x: x.dropna().iloc[0]
-                    if not x.dropna().empty
-                    else None,
-                    "Movie name": lambda x: x.dropna().iloc[0]
-                    if not x.dropna().empty
-                    else None,
-                    "Movie release date": lambda x: x.dropna().iloc[0]
-                    if not x.dropna().empty
-                    else None,
-                    "Movie box office revenue": lambda x: x.dropna().iloc[0]
-                    if not x.dropna().empty
-                    else None,
-                    "Movie languages": lambda x: x.dropna().iloc[0]
-                    if not x.dropna().empty
-                    else None,
-                    "Movie countries": lambda x: x.dropna().iloc[0]
-                    if not x.dropna().empty
-                    else None,
-                    "Movie genres": lambda x: x.dropna().iloc[0]
-                    if not x.dropna().empty
-                    else None,
-                    "character_name": lambda x: ", ".join(x[~x.isna()].astype(str)),
-                    "actor_gender": lambda x: ", ".join(x[~x.isna()].astype(str)),
-                    "actor_height_meters": lambda x: ", ".join(
-                        x[~x.isna()].astype(str)
-                    ),
-                    "actor_age_at_release": lambda x: ", ".join(
-                        x[~x.isna()].astype(str)
-                    ),
-                    "ethnicity": lambda x: ", ".join(x[~x.isna()].astype(str)),
-                }
+        candidates = movie_titles.map(tmdb_titles.value_counts()).fillna(0)
+        stats = {
+            "matched": int((matches >= 0).sum()),
+            "ambiguous": int(((candidates > 1) & (matches >= 0)).sum()),
+        }
+        return matches, stats
+
+    # Not persisted: it is only the input of `movies_with_characters`, which is
+    # persisted, so it is only built when that table is not cached. Its Arrow list
+    # columns would also need converting on read, as `read_parquet` returns them as
+    # object columns of arrays, or fails on their dtype metadata with some versions.
+    # The characters are loaded whole or streamed in chunks depending on `chunksize`
+    @cached_table(
+        "movies_with_cast",
+        inputs=["movies", "fb_wiki_index", "plot"],
+        sources=["character"],
+        whole_inputs=["characters"],
+    )
+    def load_movies_with_cast(
+        self,
+        movies: pd.DataFrame,
+        fb_wiki_index: pd.DataFrame,
+        plot: pd.DataFrame,
+        characters: pd.DataFrame = None,
+    ) -> pd.DataFrame:
+        """Load movies with their cast attributes as list columns"""
+        if characters is not None:
+            df = movies.merge(characters, on="wikipedia_movie_id", how="inner")
+            df = self._aggregate_by_movie(df)
+        else:
+            # Aggregate the characters chunk by chunk, then combine the partial
+            # aggregates of the movies whose characters span several chunks
+            df = pd.concat(
+                [
+                    self._aggregate_by_movie(
+                        movies.merge(chunk, on="wikipedia_movie_id", how="inner")
+                    )
+                    for chunk in self._iter_characters(fb_wiki_index, movies)
+                ],
+                ignore_index=True,
             )
-            .reset_index()
-        )
+            df = self._aggregate_by_movie(df)
+
+        df = pd.merge(df, plot, on="wikipedia_movie_id", how="left")
+        return df
 
-        df = pd.merge(
-            df, self.load_plot_summaries(), on="wikipedia_movie_id", how="left"
+    @cached_table(
+        "movies_with_characters", inputs=["movies_with_cast"], persist=True
+    )
+    def load_movies_with_characters(
+        self, movies_with_cast: pd.DataFrame
+    ) -> pd.DataFrame:
+        """Load movies with characters"""
+        # Join the cast attributes into comma-separated strings
+        # e.g. ["F", "M"] -> "F, M"
+        df = movies_with_cast.assign(
+            **{col: join_lists(movies_with_cast[col]) for col in CAST_COLUMNS}
         )
+
         df = reduce_genres_and_ethnicities(df)
         return df
 
+    # Not persisted: the dummy columns include duplicated separator columns
+    @cached_table("features", inputs=["movies_with_characters"])
+    def load_features(self, movies_with_characters: pd.DataFrame) -> pd.DataFrame:
+        """Load the model-ready features of the movies with characters"""
+        return preprocess_data_for_model(movies_with_characters)
+
+    @staticmethod
+    def _aggregate_by_movie(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Aggregate joined movies and characters per movie, keeping the first valid value
+        of the movie columns and gathering the valid cast values into list columns.
+        Partial aggregates whose cast columns are already lists are combined.
+        """
+        codes, movie_ids = pd.factorize(df["wikipedia_movie_id"], sort=True)
+        aggregated = df.groupby(codes)[MOVIE_COLUMNS].first()
+        aggregated.insert(0, "wikipedia_movie_id", movie_ids)
+        for col in CAST_COLUMNS:
+            if isinstance(df[col].dtype, pd.ArrowDtype):
+                lists = regroup_lists(codes, len(movie_ids), df[col])
+            else:
+                lists = group_to_lists(codes, len(movie_ids), df[col])
+            aggregated[col] = lists.values
+        return aggregated.reset_index(drop=True)
+
+    @cached_table("name", sources=["name"])
     def load_name_clusters(self) -> pd.DataFrame:
         """Load name clusters"""
         return self._load_tsv(
-            self.paths["name"],
-            names=["Character name", "Freebase character/actor map ID"],
+            self.paths["name"], names=list(SCHEMAS["name"]), dtype=SCHEMAS["name"]
         )
 
+    @cached_table("plot", sources=["plot"])
     def load_plot_summaries(self) -> pd.DataFrame:
         """Load plot summaries"""
-        df = self._load_tsv(self.paths["plot"], names=["wikipedia_movie_id", "plot"])
+        df = self._load_tsv(
+            self.paths["plot"], names=list(SCHEMAS["plot"]), dtype=SCHEMAS["plot"]
+        )
         return df
 
+    @cached_table("tvtropes", sources=["tvtropes"])
     def load_tvtropes(self) -> pd.DataFrame:
         """Load and process TV tropes data"""
-        df = self._load_tsv(self.paths["tvtropes"], names=["trope", "details"])
-        df = pd.concat(
-            [df["trope"], df["details"].apply(json.loads).apply(pd.Series)], axis=1
+        df = self._load_tsv(
+            self.paths["tvtropes"],
+            names=list(SCHEMAS["tvtropes"]),
+            dtype=SCHEMAS["tvtropes"],
         )
+        # Parse all the JSON records at once as JSON lines
+        details = pd.read_json(
+            io.StringIO("\n".join(df["details"])),
+            lines=True,
+            dtype=False,
+            convert_dates=False,
+        )
+        df = pd.concat([df["trope"], details.set_index(df.index)], axis=1)
         df.rename(columns={"id": "Freebase character/actor map ID"}, inplace=True)
         return df
 
+    @cached_table("fb_wiki", sources=["fb_wiki"])
     def load_fb_wiki_mapping(self) -> pd.DataFrame:
         """Load Freebase to Wikipedia mapping"""
-        return self._load_tsv(self.paths["fb_wiki"])
+        return self._load_tsv(self.paths["fb_wiki"], dtype=SCHEMAS["fb_wiki"])
+
+    @cached_table("fb_wiki_index", inputs=["fb_wiki"])
+    def load_fb_wiki_index(self, fb_wiki: pd.DataFrame) -> pd.DataFrame:
+        """Load Freebase to Wikipedia mapping indexed by Freebase ID"""
+        return fb_wiki.set_index("freebase_id")
@@ -4,67 +4,170 @@ from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import f1_score
 import statsmodels.api as sm
 from scipy import stats
+from scipy.special import expit
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from functools import partial
 
+from src.models.periods import map_periods, period_blocks, standardize_blocks, valid_periods
 
-def logistic_regression(df, show_details=False):
-    period_counts = df['period'].value_counts().sort_index()
 
-    # Print periods with more than 500 movies
-    valid_periods = period_counts[period_counts > 500].index
+def fit_period(period_data, show_details=False):
+    """Fit the logistic regression of the movies of a period making more than 300M and its statistics"""
+    # Split data
+    X = period_data.drop(["Movie box office revenue", "period", "Movie release date"], axis=1)
+    y = period_data["Movie box office revenue"]
+    xtrain, xtest, ytrain, ytest = train_test_split(X, y, test_size=0.1, random_state=42, shuffle=True)
 
-    features_of_interest = {}  
+    # Scale features
+    x_scaler = StandardScaler()
+    xtrain = x_scaler.fit_transform(xtrain)
+    xtest = x_scaler.transform(xtest)
 
-    # For each valid period, run a separate regression
-    for period in valid_periods:
-        # Filter data for this period
-        period_data = df[df['period'] == period]
-        
-        # Split data
-        X = period_data.drop(["Movie box office revenue", "period", "Movie release date"], axis=1)
-        y = period_data["Movie box office revenue"]
-        xtrain, xtest, ytrain, ytest = train_test_split(X, y, test_size=0.1, random_state=42, shuffle=True)
-        
-        # Scale features
-        x_scaler = StandardScaler()
-        xtrain = x_scaler.fit_transform(xtrain)
-        xtest = x_scaler.transform(xtest)
-        
-        # Convert to binary for logistic regression
-        ytrain = ytrain > 300000000
-        ytest = ytest > 300000000
-        
-        # Fit model
-        model = LogisticRegression()
-        model.fit(xtrain, ytrain)
-        
-        # Predict
-        ypred = model.predict(xtest)
-        ypred_2 = model.predict(xtrain)
+    # Convert to binary for logistic regression
+    ytrain = ytrain > 300000000
+    ytest = ytest > 300000000
 
-        # Calculate F-1 score
-        f1 = f1_score(ytest, ypred)
-        
-        # Statistical Summary
-        if show_details:  
-            model_stats = sm.Logit(ytrain, xtrain).fit()
-        else:
-            model_stats = sm.Logit(ytrain, xtrain).fit(disp=0)
-        # Create a DataFrame with coefficients and p-values
-        feature_names = list(X.columns)
+    # Fit model
+    model = LogisticRegression()
+    model.fit(xtrain, ytrain)
+
+    # Predict
+    ypred = model.predict(xtest)
+    ypred_2 = model.predict(xtrain)
+
+    # Calculate F-1 score
+    f1 = f1_score(ytest, ypred)
+
+    # Statistical Summary
+    if show_details:
+        model_stats = sm.Logit(ytrain, xtrain).fit()
+    else:
+        model_stats = sm.Logit(ytrain, xtrain).fit(disp=0)
+    # Create a DataFrame with coefficients and p-values
+    feature_names = list(X.columns)
+    coef_df = pd.DataFrame({
+        'Feature': feature_names,
+        'Coefficient': model_stats.params,
+        'P-value': model_stats.pvalues
+    })
+    return {"features": coef_df, "f1": f1}
+
+def logit_derivatives(values, target, bounds, params):
+    """
+    Gradients and Hessians of the negative log-likelihood of logistic regressions at `params`, on
+    the train rows of the given period blocks (see `period_blocks`)
+    """
+    gradients = np.empty(params.shape)
+    hessians = np.empty(params.shape + params.shape[-1:])
+    for i, (start, test_start, _) in enumerate(bounds):
+        block = values[start:test_start]
+        probabilities = expit(block @ params[i])
+        gradients[i] = block.T @ (probabilities - target[start:test_start])
+        hessians[i] = block.T @ (block * (probabilities * (1 - probabilities))[:, None])
+    return gradients, hessians
+
+def newton_logit(values, target, bounds, penalty=None, max_iter=35, tol=1e-8):
+    """
+    Fit a logistic regression on the train rows of each period's block (see `period_blocks`) with
+    Newton's method, as statsmodels' `Logit.fit`, all the periods at once: each iteration takes
+    one pass over the rows of the periods that have not converged yet and solves their Newton
+    steps in a batched call. `penalty` is an optional quadratic penalty matrix added to the
+    negative log-likelihood (e.g. the L2 penalty of sklearn's `LogisticRegression`).
+
+    Returns:
+    -------
+    The parameters of the periods and the Hessians of the penalized negative log-likelihood at them.
+    """
+    n_periods, n_params = len(bounds), values.shape[1]
+    penalty = np.zeros((n_params, n_params)) if penalty is None else penalty
+    # Ridge factor of statsmodels' Newton method for singular Hessians, which it adds to the Hessian
+    # of the mean log-likelihood
+    ridge_factor = 1e-10 * (bounds[:, 1] - bounds[:, 0])[:, None, None] * np.eye(n_params)
+    params = np.zeros((n_periods, n_params))
+    active = np.arange(n_periods)
+    for _ in range(max_iter):
+        gradient, hessian = logit_derivatives(values, target, bounds[active], params[active])
+        gradient += params[active] @ penalty
+        step = np.linalg.solve(hessian + penalty + ridge_factor[active], gradient[..., None])[..., 0]
+        params[active] -= step
+        # Periods stop as statsmodels once no parameter moves by more than `tol`
+        active = active[np.any(np.abs(step) > tol, axis=1)]
+        if len(active) == 0:
+            break
+    return params, logit_derivatives(values, target, bounds, params)[1] + penalty
+
+def fit_periods_grouped(df, periods):
+    """
+    Fit the logistic regressions of `fit_period` for all the given periods in one pass over the
+    data: the rows are sorted by period once (see `period_blocks`), standardized per period, and
+    every Newton iteration of all the periods is solved in batched calls (see `newton_logit`).
+    Returns the fits of the periods, as returned by `fit_period`.
+    """
+    X = df.drop(["Movie box office revenue", "period", "Movie release date"], axis=1)
+    positions, bounds = period_blocks(df, periods)
+    scaled = standardize_blocks(X.to_numpy(dtype=float)[positions], bounds)[0]
+    target = (df["Movie box office revenue"].to_numpy()[positions] > 300000000).astype(float)
+
+    # Classifier of sklearn's LogisticRegression: intercept and L2 penalty (C=1) on the coefficients
+    with_intercept = np.column_stack([np.ones(len(scaled)), scaled])
+    penalty = np.eye(with_intercept.shape[1])
+    penalty[0, 0] = 0
+    classifier = newton_logit(with_intercept, target, bounds, penalty)[0]
+
+    # Statistics of sm.Logit on the scaled features, without constant
+    params, hessian = newton_logit(scaled, target, bounds)
+    # Standard errors from the inverse Hessian, ignoring its numerically null eigenvalues. Features
+    # in their span (collinear or constant features) are not identified and get NaN p-values,
+    # where statsmodels' inverse of the singular Hessian gives meaningless huge (or negative) values.
+    eigenvalues, eigenvectors = np.linalg.eigh(hessian)
+    n_train = bounds[:, 1] - bounds[:, 0]
+    threshold = eigenvalues.max(axis=-1) * np.maximum(n_train, scaled.shape[1]) * np.finfo(float).eps
+    kept = eigenvalues > threshold[:, None]
+    inverse_eigenvalues = np.where(kept, 1 / np.where(kept, eigenvalues, 1), 0)
+    variances = (eigenvectors ** 2 * inverse_eigenvalues[:, None, :]).sum(axis=-1)
+    unidentified = (eigenvectors ** 2 * ~kept[:, None, :]).sum(axis=-1) > 1e-8
+    bse = np.where(unidentified, np.nan, np.sqrt(variances))
+    pvalues = 2 * stats.norm.sf(np.abs(params / bse))
+
+    fits = []
+    for i, (start, test_start, end) in enumerate(bounds):
+        ypred = with_intercept[test_start:end] @ classifier[i] > 0
+        # Same index as the statsmodels parameters of unnamed features
         coef_df = pd.DataFrame({
-            'Feature': feature_names,
-            'Coefficient': model_stats.params,
-            'P-value': model_stats.pvalues
-        })
+            'Feature': list(X.columns),
+            'Coefficient': params[i],
+            'P-value': pvalues[i]
+        }, index=[f"x{j}" for j in range(1, X.shape[1] + 1)])
+        fits.append({"features": coef_df, "f1": f1_score(target[test_start:end] > 0, ypred)})
+    return fits
+
+def logistic_regression(df, show_details=False, n_jobs=None, grouped=False):
+    """
+    Run a separate logistic regression for each period with more than 500 movies, fitting the
+    periods in `n_jobs` processes (see `map_periods`), or all together in one pass over the data
+    when `grouped` (see `fit_periods_grouped`)
+    """
+    period_counts = valid_periods(df)
+    periods = period_counts.index
+    if grouped:
+        fits = fit_periods_grouped(df, periods)
+    else:
+        fits = map_periods(
+            partial(fit_period, show_details=show_details),
+            [df[df['period'] == period] for period in periods],
+            n_jobs,
+        )
 
+    features_of_interest = {}
+    for period, fit in zip(periods, fits):
+        coef_df = fit["features"]
         if show_details:
         # Print period information
             print(period)
             print("\nModel Statistics:")
-            print("F-1 Score:", f1)
+            print("F-1 Score:", fit["f1"])
             print("\nFeature Coefficients and P-values:")
             print(coef_df)
 
@@ -74,7 +177,7 @@ def logistic_regression(df, show_details=False):
     if show_details:
         # Print the number of movies in each period
         print("\nNumber of movies in each period:")
-        print(period_counts[valid_periods])
+        print(period_counts)
     return features_of_interest
 
 def plot_important_features(features_of_interest):
@@ -0,0 +1,94 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+
+
+def valid_periods(df, min_movies=500):
+    """Number of movies of the periods with more than `min_movies` movies, in period order"""
+    period_counts = df['period'].value_counts().sort_index()
+    return period_counts[period_counts > min_movies]
+
+
+def map_periods(fit, period_frames, n_jobs=None):
+    """
+    Apply a fitting function to the data of each period, in a pool of `n_jobs` processes (all the
+    cores for -1) or serially when `n_jobs` is None or 1. The results are returned in the order of
+    the periods either way. `fit` must be a module-level function (or a partial of one) so that it
+    can be sent to the worker processes.
+    """
+    if n_jobs is None or n_jobs == 1 or len(period_frames) <= 1:
+        return [fit(period_data) for period_data in period_frames]
+    max_workers = os.cpu_count() if n_jobs == -1 else n_jobs
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(period_frames))) as executor:
+        return list(executor.map(fit, period_frames))
+
+
+def period_blocks(df, periods, test_size=0.1, random_state=42):
+    """
+    Sort the rows of the given periods by period once, for fitting all the periods in one pass.
+    Within its block, each period has its train rows followed by its test rows, split exactly as
+    `train_test_split(period_data, test_size=test_size, random_state=random_state, shuffle=True)`
+    splits the period's rows alone.
+
+    Returns:
+    -------
+    positions : Positions of the rows in `df`, in block order.
+    bounds : (periods, 3) array of the start of the train rows, the start of the test rows and the
+        end of each period's block in `positions`.
+    """
+    codes = pd.Categorical(df['period'], categories=periods).codes
+    order = np.argsort(codes, kind="stable")
+    counts = np.bincount(codes[codes >= 0], minlength=len(periods))
+    # Rows of the other periods have code -1 and come first
+    order = order[len(codes) - counts.sum():]
+    starts = np.concatenate([[0], np.cumsum(counts)])
+
+    positions = np.empty_like(order)
+    bounds = np.empty((len(periods), 3), dtype=np.int64)
+    for i, (start, end) in enumerate(zip(starts[:-1], starts[1:])):
+        train, test = train_test_split(
+            np.arange(start, end), test_size=test_size, random_state=random_state, shuffle=True
+        )
+        positions[start:end] = order[np.concatenate([train, test])]
+        bounds[i] = start, start + len(train), end
+    return positions, bounds
+
+
+def block_sums(values, bounds):
+    """Sums of the rows of the train blocks and of the test blocks, each of shape (periods, ...)"""
+    sums = np.add.reduceat(values, bounds[:, :2].ravel(), axis=0)
+    lengths = np.diff(np.append(bounds[:, :2].ravel(), bounds[-1, 2]))
+    # reduceat returns the first row instead of 0 for empty blocks
+    sums[lengths == 0] = 0
+    return sums[0::2], sums[1::2]
+
+
+def standardize_blocks(values, bounds):
+    """
+    Standardize the columns of each period's block by the mean and standard deviation of its train
+    rows, as a `StandardScaler` fitted on the train rows of each period (constant columns keep a
+    scale of 1). Returns the standardized values, the means and the scales of the periods.
+    """
+    lengths = np.diff(bounds, axis=1).sum(axis=1)
+    n_train = bounds[:, 1] - bounds[:, 0]
+    means = block_sums(values, bounds)[0] / n_train[:, None]
+    centered = values - np.repeat(means, lengths, axis=0)
+    var = block_sums(centered ** 2, bounds)[0] / n_train[:, None]
+    # Constant detection of `StandardScaler`, from the error bounds of the two-pass variance
+    eps = np.finfo(np.float64).eps
+    constant = var <= n_train[:, None] * eps * var + (n_train[:, None] * means * eps) ** 2
+    scales = np.where(constant, 1.0, np.sqrt(var))
+    return centered / np.repeat(scales, lengths, axis=0), means, scales
+
+
+def block_grams(values, bounds, weights=None):
+    """Stacked Gram matrices of the train rows of each period, optionally with row weights"""
+    grams = np.empty((len(bounds), values.shape[1], values.shape[1]))
+    for i, (start, test_start, _) in enumerate(bounds):
+        block = values[start:test_start]
+        weighted = block if weights is None else block * weights[start:test_start, None]
+        grams[i] = block.T @ weighted
+    return grams
@@ -1,114 +1,460 @@
 from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import StandardScaler, PolynomialFeatures
-from sklearn.linear_model import Ridge
-import statsmodels.api as sm
+from sklearn.preprocessing import StandardScaler
 from scipy import stats
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-
-def ridge_regression_characters_general(df, show_details=False):
-    period_counts = df['period'].value_counts().sort_index()
-
-    # Print periods with more than 500 movies
-    valid_periods = period_counts[period_counts > 500].index
-
-    features_of_interest = {}  # Initialize as dictionary 
-
-    # For each valid period, run a separate regression
-    for period in valid_periods:
-        # Filter data for this period
-        period_data = df[df['period'] == period]
-        
-        # Split data
-        X = period_data.drop(["Movie box office revenue", "period", "Movie release date", "African Ethnicities","Indigenous Peoples", "Western European Ethnicities", 
-                            "Northern European Ethnicities", "Southern European Ethnicities", "Eastern European Ethnicities",
-                            "Asian Ethnicities", "Middle Eastern and Arab Ethnicities","Latin American Ethnicities", "Jewish Communities", "American Ethnicities",
-                                "Oceanian Ethnicities"], axis=1)
-        y = period_data["Movie box office revenue"]
-        xtrain, xtest, ytrain, ytest = train_test_split(X, y, test_size=0.1, random_state=42, shuffle=True)
-        
-        # Scale features
-        x_scaler = StandardScaler()
-        xtrain = x_scaler.fit_transform(xtrain)
-        xtest = x_scaler.transform(xtest)
-        
-        y_scaler = StandardScaler()
-        ytrain = y_scaler.fit_transform(ytrain.values.reshape(-1, 1)).ravel()
-        
-        # Fit model
-        model = Ridge(alpha=100.0)
-        model.fit(xtrain, ytrain)
-        
-        # Predict and inverse transform
-        ypred = model.predict(xtest)
-        ypred = y_scaler.inverse_transform(ypred.reshape(-1, 1)).ravel()
-        ypred_2 = model.predict(xtrain)
-        #ypred_2 = y_scaler.inverse_transform(ypred_2.reshape(-1, 1)).ravel()
-
-        if show_details:
-            fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15, 6))
-
-            # Create subplot
-            ax1.scatter(ytest, ypred, alpha=0.6, label="Revenue", color="blue")
-            ax1.plot([ytest.min(), ytest.max()], [ytest.min(), ytest.max()], 'r--', label="Perfect Prediction Line")
-            ax1.set_xscale('log')
-            ax1.set_yscale("log")
-            ax1.set_xlabel("Actual Values")
-            ax1.set_ylabel("Predicted Values")
-            ax1.set_title(f"Period {period} : Test data")
-            ax1.legend()
-
-            ax2.scatter(ytrain, ypred_2, alpha=0.6, label="Revenue", color="blue")
-            ax2.plot([ytrain.min(), ytrain.max()], [ytrain.min(), ytrain.max()], 'r--', label="Perfect Prediction Line")
-            ax2.set_xscale('log')
-            ax2.set_yscale("log")
-            ax2.set_xlabel("Actual Values")
-            ax2.set_ylabel("Predicted Values")
-            ax2.set_title(f"Period {period} : Train data")
-            ax2.legend()
-
-        # Statistical Summary
-        X_with_const = sm.add_constant(xtrain)
-        model_stats = sm.OLS(ytrain, X_with_const).fit()
-        # Create a DataFrame with coefficients and p-values
-        feature_names = ['const'] + list(X.columns)
-        coef_df = pd.DataFrame({
-            'Feature': feature_names,
-            'Coefficient': model_stats.params,
-            'P-value': model_stats.pvalues
+from functools import partial
+
+from src.models.periods import block_grams, map_periods, period_blocks, standardize_blocks, valid_periods
+
+ETHNICITY_COLUMNS = [
+    "African Ethnicities", "Indigenous Peoples", "Western European Ethnicities",
+    "Northern European Ethnicities", "Southern European Ethnicities", "Eastern European Ethnicities",
+    "Asian Ethnicities", "Middle Eastern and Arab Ethnicities", "Latin American Ethnicities",
+    "Jewish Communities", "American Ethnicities", "Oceanian Ethnicities"
+]
+
+def fit_ridge_ols(X, y, alpha=100.0):
+    """
+    Fit a ridge regression (with intercept, like sklearn's `Ridge`) and an OLS regression with a
+    constant (like `sm.OLS(y, sm.add_constant(X))`) from the sufficient statistics of the data,
+    computed in a single pass: the Gram matrix [1 X]ᵀ[1 X] and [1 X]ᵀy (see `ridge_ols_from_gram`).
+
+    Returns:
+    -------
+    Dictionary with the ridge "coef" and "intercept", and the OLS "params", "bse", "pvalues",
+    "rsquared" and "df_resid" (the constant first in the OLS arrays).
+    """
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float)
+    X_with_const = np.column_stack([np.ones(len(y)), X])
+    return ridge_ols_from_gram(X_with_const.T @ X_with_const, X_with_const.T @ y, y @ y, alpha)
+
+def centered_statistics(gram, xty):
+    """Number of rows, means and centered Gram matrix and Xᵀy of the features from [1 X]ᵀ[1 X] and [1 X]ᵀy"""
+    n = gram[..., 0, 0]
+    x_mean = gram[..., 0, 1:] / n[..., None]
+    y_mean = xty[..., 0] / n
+    centered_gram = gram[..., 1:, 1:] - n[..., None, None] * x_mean[..., :, None] * x_mean[..., None, :]
+    centered_xty = xty[..., 1:] - (n * y_mean)[..., None] * x_mean
+    return n, x_mean, y_mean, centered_gram, centered_xty
+
+def ridge_ols_from_gram(gram, xty, yty, alpha=100.0):
+    """
+    Ridge and OLS fits of `fit_ridge_ols` from the Gram matrix [1 X]ᵀ[1 X], [1 X]ᵀy and yᵀy, or
+    from stacks of them to fit many regressions (e.g. one per period) in batched calls.
+
+    The OLS solution uses the pseudo-inverse of the Gram matrix from its eigendecomposition, so
+    collinear or constant features get the minimum norm solution and NaN p-values as with
+    statsmodels' default "pinv" method. `alpha` can also be an array of one alpha per regression.
+    """
+    gram, xty, yty = np.asarray(gram, dtype=float), np.asarray(xty, dtype=float), np.asarray(yty, dtype=float)
+    n, x_mean, y_mean, centered_gram, centered_xty = centered_statistics(gram, xty)
+    p = gram.shape[-1] - 1
+
+    # Ridge on the centered data, from the centered sufficient statistics
+    ridge_penalty = np.asarray(alpha, dtype=float)[..., None, None] * np.eye(p)
+    coef = np.linalg.solve(centered_gram + ridge_penalty, centered_xty[..., None])[..., 0]
+    intercept = y_mean - (x_mean * coef).sum(axis=-1)
+
+    # OLS from the pseudo-inverse of the Gram matrix, ignoring the numerically null eigenvalues
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    threshold = eigenvalues.max(axis=-1) * np.maximum(n, p + 1) * np.finfo(float).eps
+    kept = eigenvalues > threshold[..., None]
+    inverse_eigenvalues = np.where(kept, 1 / np.where(kept, eigenvalues, 1), 0)
+    inverse_gram = (eigenvectors * inverse_eigenvalues[..., None, :]) @ np.swapaxes(eigenvectors, -1, -2)
+    # Constant features have no coefficient, exactly as with the pseudo-inverse of X
+    constant = np.diagonal(gram, axis1=-2, axis2=-1) == 0
+    inverse_gram = np.where(constant[..., :, None] | constant[..., None, :], 0, inverse_gram)
+    params = (inverse_gram @ xty[..., None])[..., 0]
+
+    fitted = (params[..., None, :] @ gram @ params[..., :, None])[..., 0, 0]
+    ssr = np.maximum(yty - 2 * (params * xty).sum(axis=-1) + fitted, 0)
+    df_resid = n - kept.sum(axis=-1)
+    scale = ssr / df_resid
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bse = np.sqrt(scale[..., None] * np.maximum(np.diagonal(inverse_gram, axis1=-2, axis2=-1), 0))
+        pvalues = 2 * stats.t.sf(np.abs(params / bse), df_resid[..., None])
+    rsquared = 1 - ssr / (yty - n * y_mean ** 2)
+    return {
+        "coef": coef,
+        "intercept": intercept,
+        "params": params,
+        "bse": bse,
+        "pvalues": pvalues,
+        "rsquared": rsquared,
+        "df_resid": df_resid,
+    }
+
+# Default grid of the ridge path, around the alpha=100 used by the per-period fits
+RIDGE_ALPHAS = np.logspace(-2, 4, 100)
+
+def ridge_path(X, y, alphas=RIDGE_ALPHAS, X_test=None, y_test=None):
+    """
+    Fit ridge regressions (with intercept, like sklearn's `Ridge`) for a whole grid of alphas from
+    a single thin SVD of the centered features X = U diag(s) Vᵀ. Each alpha then only rescales the
+    singular values: coef = V diag(s / (s² + alpha)) Uᵀy, with effective degrees of freedom
+    sum(s² / (s² + alpha)).
+
+    Alpha is selected by generalized cross-validation, GCV = n RSS / (n - df - 1)², the intercept
+    counting as one more degree of freedom.
+
+    Returns:
+    -------
+    Dictionary with the "path" DataFrame (one row per alpha with its "df", "train_mse", "gcv" and
+    "test_mse" when test data is given), the "coefs" (alphas x features) and "intercepts" of the
+    path, and the GCV "best_alpha", "coef" and "intercept".
+    """
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float)
+    alphas = np.asarray(alphas, dtype=float)
+    n = len(y)
+    x_mean = X.mean(axis=0)
+    y_mean = y.mean()
+    U, s, Vt = np.linalg.svd(X - x_mean, full_matrices=False)
+    yc = y - y_mean
+    uty = U.T @ yc
+
+    # Shrinkage of each singular direction for each alpha (alphas x directions)
+    shrinkage = s ** 2 / (s ** 2 + alphas[:, None])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coefs = (shrinkage * np.where(s > 0, uty / s, 0)) @ Vt
+    intercepts = y_mean - coefs @ x_mean
+    dof = shrinkage.sum(axis=1)
+    # Residuals outside of the span of U are the same for every alpha
+    rss = (yc @ yc - uty @ uty) + (((1 - shrinkage) * uty) ** 2).sum(axis=1)
+    path = pd.DataFrame({
+        "alpha": alphas,
+        "df": dof,
+        "train_mse": rss / n,
+        "gcv": n * rss / (n - dof - 1) ** 2,
+    })
+    if X_test is not None and y_test is not None:
+        residuals = np.asarray(y_test, dtype=float)[:, None] - (np.asarray(X_test, dtype=float) @ coefs.T + intercepts)
+        path["test_mse"] = (residuals ** 2).mean(axis=0)
+
+    best = int(np.argmin(path["gcv"].to_numpy()))
+    return {
+        "path": path,
+        "coefs": coefs,
+        "intercepts": intercepts,
+        "best_alpha": alphas[best],
+        "coef": coefs[best],
+        "intercept": intercepts[best],
+    }
+
+def gcv_alpha(gram, xty, yty, alphas=RIDGE_ALPHAS):
+    """
+    Alpha selected by generalized cross-validation among `alphas`, as in `ridge_path`, from the
+    Gram matrix [1 X]ᵀ[1 X], [1 X]ᵀy and yᵀy (or stacks of them, returning one alpha for each).
+    The eigendecomposition of the centered Gram matrix gives the squared singular values and the
+    projections Uᵀy of the SVD of the centered features.
+    """
+    alphas = np.asarray(alphas, dtype=float)
+    n, x_mean, y_mean, centered_gram, centered_xty = centered_statistics(gram, xty)
+    eigenvalues, eigenvectors = np.linalg.eigh(centered_gram)
+    kept = eigenvalues > eigenvalues.max(axis=-1, keepdims=True) * gram.shape[-1] * np.finfo(float).eps
+    projections = (np.swapaxes(eigenvectors, -1, -2) @ centered_xty[..., None])[..., 0]
+    uty2 = np.where(kept, projections ** 2 / np.where(kept, eigenvalues, 1), 0)
+
+    shrinkage = np.where(kept, eigenvalues, 0)[..., None, :] / (eigenvalues[..., None, :] + alphas[:, None])
+    rss = (yty - n * y_mean ** 2 - uty2.sum(axis=-1))[..., None] + ((1 - shrinkage) ** 2 * uty2[..., None, :]).sum(axis=-1)
+    dof = shrinkage.sum(axis=-1)
+    gcv = n[..., None] * rss / (n[..., None] - dof - 1) ** 2
+    return alphas[np.argmin(gcv, axis=-1)]
+
+def prepare_period(period_data, drop_columns=()):
+    """Split the data of a period into scaled train and test sets"""
+    X = period_data.drop(["Movie box office revenue", "period", "Movie release date"] + list(drop_columns), axis=1)
+    y = period_data["Movie box office revenue"]
+    xtrain, xtest, ytrain, ytest = train_test_split(X, y, test_size=0.1, random_state=42, shuffle=True)
+
+    # Scale features
+    x_scaler = StandardScaler()
+    xtrain_scaled = x_scaler.fit_transform(xtrain)
+    xtest_scaled = x_scaler.transform(xtest)
+
+    y_scaler = StandardScaler()
+    ytrain_scaled = y_scaler.fit_transform(ytrain.values.reshape(-1, 1)).ravel()
+    return {
+        "columns": list(X.columns),
+        "xtrain": xtrain_scaled,
+        "xtest": xtest_scaled,
+        "ytrain": ytrain_scaled,
+        "ytest": ytest,
+        "ytrain_revenue": ytrain,
+        "y_scaler": y_scaler,
+    }
+
+def fit_period_path(period_data, alphas=RIDGE_ALPHAS, drop_columns=()):
+    """
+    Ridge path of the revenue of the movies of a period over a grid of alphas (see `ridge_path`),
+    with the test error of each alpha in scaled revenue units
+    """
+    data = prepare_period(period_data, drop_columns)
+    ytest = data["y_scaler"].transform(data["ytest"].values.reshape(-1, 1)).ravel()
+    fit = ridge_path(data["xtrain"], data["ytrain"], alphas, data["xtest"], ytest)
+    fit["coefs"] = pd.DataFrame(fit["coefs"], index=pd.Index(fit["path"]["alpha"], name="alpha"), columns=data["columns"])
+    return fit
+
+def ridge_path_by_period(df, alphas=RIDGE_ALPHAS, drop_columns=(), n_jobs=None):
+    """
+    Ridge path of each period with more than 500 movies over a grid of alphas, fitting the periods
+    in `n_jobs` processes (see `map_periods`). Returns a dictionary of the `fit_period_path` of each
+    period, whose "best_alpha" is the alpha selected for the period by GCV.
+    """
+    periods = valid_periods(df).index
+    fits = map_periods(
+        partial(fit_period_path, alphas=alphas, drop_columns=drop_columns),
+        [df[df['period'] == period] for period in periods],
+        n_jobs,
+    )
+    return dict(zip(periods, fits))
+
+def significant_coefficients(feature_names, params, pvalues, y_mean, y_scale):
+    """
+    Features of a period's regression significant at 5%, sorted by coefficient, with their
+    coefficients back in the scale of the revenue
+    """
+    # Statistical Summary
+    # Create a DataFrame with coefficients and p-values
+    coef_df = pd.DataFrame({
+        'Feature': feature_names,
+        'Coefficient': params,
+        'P-value': pvalues
+    })
+
+    ###Change code snippet because we dont sort by absolute value anymore
+    coef_df['Abs_Coefficient'] = coef_df['Coefficient']
+    coef_df = coef_df.sort_values('Abs_Coefficient', ascending=False)
+    coef_df = coef_df.drop('Abs_Coefficient', axis=1)
+
+    # Filter for p-value < 0.05 and display
+    significant_features = coef_df[coef_df['P-value'] < 0.05]
+    significant_features = significant_features[significant_features['Feature'] != 'const']
+    # Inverse transform the coefficients to get them back to original scale
+    # Corrected to use x_scaler for inverse transform
+    significant_features['Coefficient'] = significant_features['Coefficient'] * y_scale + y_mean
+    return significant_features
+
+def fit_period(period_data, drop_columns=(), alpha=100.0):
+    """
+    Fit the ridge regression of the revenue of the movies of a period and its OLS statistics.
+    `alpha` can be "gcv" to select it for the period by generalized cross-validation on the ridge
+    path (see `ridge_path`).
+    """
+    data = prepare_period(period_data, drop_columns)
+    xtrain, xtest, ytrain = data["xtrain"], data["xtest"], data["ytrain"]
+    ytest, ytrain_revenue, y_scaler = data["ytest"], data["ytrain_revenue"], data["y_scaler"]
+
+    # Fit the ridge model and the OLS statistics from the same sufficient statistics
+    if isinstance(alpha, str) and alpha == "gcv":
+        alpha = ridge_path(xtrain, ytrain)["best_alpha"]
+    model_stats = fit_ridge_ols(xtrain, ytrain, alpha=alpha)
+
+    # Predict and inverse transform
+    ypred = xtest @ model_stats["coef"] + model_stats["intercept"]
+    ypred = y_scaler.inverse_transform(ypred.reshape(-1, 1)).ravel()
+    ypred_2 = xtrain @ model_stats["coef"] + model_stats["intercept"]
+    #ypred_2 = y_scaler.inverse_transform(ypred_2.reshape(-1, 1)).ravel()
+
+    return {
+        "features": significant_coefficients(
+            ['const'] + data["columns"], model_stats["params"], model_stats["pvalues"],
+            y_scaler.mean_[0], y_scaler.scale_[0],
+        ),
+        "rsquared": model_stats["rsquared"],
+        "ytest": ytest,
+        "ypred": ypred,
+        "ytrain": ytrain_revenue,
+        "ypred_2": ypred_2,
+        "alpha": alpha,
+    }
+
+def fit_periods_grouped(df, periods, drop_columns=(), alpha=100.0):
+    """
+    Fit the regressions of `fit_period` for all the given periods in one pass over the data: the
+    rows are sorted by period once (see `period_blocks`), standardized per period, and the Gram
+    matrices of all the periods are accumulated and solved in batched calls. `alpha` is a single
+    alpha, an array with the alpha of each period, or "gcv". Returns the fits of the periods, as
+    returned by `fit_period`.
+    """
+    X = df.drop(["Movie box office revenue", "period", "Movie release date"] + list(drop_columns), axis=1)
+    columns = list(X.columns)
+    positions, bounds = period_blocks(df, periods)
+    revenue = df["Movie box office revenue"].iloc[positions]
+    values = np.column_stack([X.to_numpy(dtype=float)[positions], revenue.to_numpy(dtype=float)])
+    scaled, means, scales = standardize_blocks(values, bounds)
+
+    # Gram matrices of [1 X y] of the train rows of every period
+    grams = block_grams(np.column_stack([np.ones(len(scaled)), scaled]), bounds)
+    gram, xty, yty = grams[:, :-1, :-1], grams[:, :-1, -1], grams[:, -1, -1]
+    if isinstance(alpha, str) and alpha == "gcv":
+        alpha = gcv_alpha(gram, xty, yty)
+    model_stats = ridge_ols_from_gram(gram, xty, yty, alpha)
+    alphas = np.broadcast_to(alpha, len(periods))
+
+    fits = []
+    for i, (start, test_start, end) in enumerate(bounds):
+        coef, intercept = model_stats["coef"][i], model_stats["intercept"][i]
+        y_mean, y_scale = means[i, -1], scales[i, -1]
+        ypred = (scaled[test_start:end, :-1] @ coef + intercept) * y_scale + y_mean
+        ypred_2 = scaled[start:test_start, :-1] @ coef + intercept
+        fits.append({
+            "features": significant_coefficients(
+                ['const'] + columns, model_stats["params"][i], model_stats["pvalues"][i], y_mean, y_scale,
+            ),
+            "rsquared": model_stats["rsquared"][i],
+            "ytest": revenue.iloc[test_start:end],
+            "ypred": ypred,
+            "ytrain": revenue.iloc[start:test_start],
+            "ypred_2": ypred_2,
+            "alpha": alphas[i],
         })
+    return fits
+
+def show_period_fit(period, fit):
+    """Plot the predictions of the model of a period and print its statistics"""
+    ytest, ypred, ytrain, ypred_2 = fit["ytest"], fit["ypred"], fit["ytrain"], fit["ypred_2"]
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15, 6))
+
+    # Create subplot
+    ax1.scatter(ytest, ypred, alpha=0.6, label="Revenue", color="blue")
+    ax1.plot([ytest.min(), ytest.max()], [ytest.min(), ytest.max()], 'r--', label="Perfect Prediction Line")
+    ax1.set_xscale('log')
+    ax1.set_yscale("log")
+    ax1.set_xlabel("Actual Values")
+    ax1.set_ylabel("Predicted Values")
+    ax1.set_title(f"Period {period} : Test data")
+    ax1.legend()
+
+    ax2.scatter(ytrain, ypred_2, alpha=0.6, label="Revenue", color="blue")
+    ax2.plot([ytrain.min(), ytrain.max()], [ytrain.min(), ytrain.max()], 'r--', label="Perfect Prediction Line")
+    ax2.set_xscale('log')
+    ax2.set_yscale("log")
+    ax2.set_xlabel("Actual Values")
+    ax2.set_ylabel("Predicted Values")
+    ax2.set_title(f"Period {period} : Train data")
+    ax2.legend()
+
+    # Display period information
+    print(period)
+    print("\nModel Statistics:")
+    print("Ridge alpha:", fit["alpha"])
+    print("R-squared:", fit["rsquared"])
+    print("\nFeature Coefficients and P-values:")
+    print(fit["features"])
 
-        # Sort by absolute coefficient value
-        coef_df['Abs_Coefficient'] = coef_df['Coefficient']
-        coef_df = coef_df.sort_values('Abs_Coefficient', ascending=False)
-        coef_df = coef_df.drop('Abs_Coefficient', axis=1)
-
-        # Filter for p-value < 0.05 and display
-        significant_features = coef_df[coef_df['P-value'] < 0.05]
-        significant_features = significant_features[significant_features['Feature'] != 'const']
-        # Inverse transform the coefficients to get them back to original scale
-        # Corrected to use x_scaler for inverse transform
-        significant_features['Coefficient'] = y_scaler.inverse_transform(significant_features['Coefficient'].values.reshape(-1, 1)).ravel()
-        features_of_interest[period] = significant_features  # Store in dictionary
+    plt.tight_layout()
+    plt.show()
 
+def ridge_regression_by_period(df, drop_columns=(), show_details=False, n_jobs=None, alpha=100.0, grouped=False):
+    """
+    Run a separate regression for each period with more than 500 movies, fitting the periods in
+    `n_jobs` processes (see `map_periods`), or all together in one pass over the data when
+    `grouped` (see `fit_periods_grouped`). With `alpha="gcv"` the ridge alpha of each period is
+    selected by generalized cross-validation.
+    """
+    period_counts = valid_periods(df)
+    periods = period_counts.index
+    if grouped:
+        fits = fit_periods_grouped(df, periods, drop_columns, alpha)
+    else:
+        fits = map_periods(
+            partial(fit_period, drop_columns=drop_columns, alpha=alpha),
+            [df[df['period'] == period] for period in periods],
+            n_jobs,
+        )
+
+    features_of_interest = {}  # Initialize as dictionary
+    for period, fit in zip(periods, fits):
+        features_of_interest[period] = fit["features"]  # Store in dictionary
         if show_details:
-            # Display period information
-            print(period)
-            print("\nModel Statistics:")
-            print("R-squared:", model_stats.rsquared)
-            print("\nFeature Coefficients and P-values:")
-            print(significant_features)
-
-            plt.tight_layout()
-            plt.show()
+            show_period_fit(period, fit)
 
     if show_details:
         # Print the number of movies in each period
         print("\nNumber of movies in each period:")
-        print(period_counts[valid_periods])
+        print(period_counts)
     return features_of_interest
 
+def rolling_ridge_regression(df, window=5, step=1, drop_columns=(), alpha=100.0, min_movies=500):
+    """
+    Run the regressions of `fit_period` on sliding windows of `window` release years every `step`
+    years (e.g. 1985-1989, 1986-1990, ... by default), for the windows with more than `min_movies`
+    movies. Each window is fitted on all its movies, without a test set.
+
+    The Gram matrix [1 X y]ᵀ[1 X y] of each release year is computed once, in one pass over the
+    rows sorted by year. The Gram matrix of a window is then the one of the previous window plus
+    the matrices of the years entering it minus the ones of the years leaving it, the features are
+    standardized per window from it, and all the windows are solved in batched calls (see
+    `ridge_ols_from_gram`). The windows thus cost the same whatever their number of movies.
+
+    Returns:
+    -------
+    features_of_interest : Significant features of each window, as for `ridge_regression_by_period`.
+    ridge_coefficients : DataFrame of the ridge coefficients of the standardized features (windows x
+        features), the trajectories of the coefficients over time.
+    """
+    X = df.drop(["Movie box office revenue", "period", "Movie release date"] + list(drop_columns), axis=1)
+    columns = list(X.columns)
+    values = np.column_stack([X.to_numpy(dtype=float), df["Movie box office revenue"].to_numpy(dtype=float)])
+    # Centered on the overall means, for the sums of squares to keep their precision when years
+    # are removed from the windows
+    offsets = values.mean(axis=0)
+    values = np.column_stack([np.ones(len(values)), values - offsets])
+
+    # Gram matrices of the release years, the rows sorted by year once
+    year_index = df["Movie release date"].to_numpy(dtype=int)
+    first_year = year_index.min()
+    year_index = year_index - first_year
+    year_counts = np.bincount(year_index)
+    ends = np.cumsum(year_counts)
+    bounds = np.column_stack([ends - year_counts, ends, ends])
+    year_grams = block_grams(values[np.argsort(year_index, kind="stable")], bounds)
+
+    # Slide the windows over the years, adding the years entering and removing the ones leaving
+    window_starts = np.arange(0, max(len(year_counts) - window, 0) + 1, step)
+    grams = np.empty((len(window_starts),) + year_grams.shape[1:])
+    gram, previous = year_grams[:window].sum(axis=0), 0
+    for i, start in enumerate(window_starts):
+        gram = gram + year_grams[previous + window:start + window].sum(axis=0) - year_grams[previous:start].sum(axis=0)
+        grams[i], previous = gram, start
+    valid = grams[:, 0, 0] > min_movies
+    grams, window_starts = grams[valid], window_starts[valid] + first_year
+
+    # Gram matrices of the features and revenue standardized per window, as with `StandardScaler`
+    n = grams[:, 0, 0]
+    means = grams[:, 0, 1:] / n[:, None]
+    centered = grams[:, 1:, 1:] - n[:, None, None] * means[:, :, None] * means[:, None, :]
+    sums_of_squares = np.diagonal(centered, axis1=-2, axis2=-1)
+    # Constant columns, up to the rounding of the differences of the sums of squares
+    constant = sums_of_squares <= n[:, None] * np.finfo(float).eps * np.diagonal(grams[:, 1:, 1:], axis1=-2, axis2=-1)
+    scales = np.where(constant, 1.0, np.sqrt(sums_of_squares / n[:, None]))
+    standardized = centered / (scales[:, :, None] * scales[:, None, :])
+    standardized[constant[:, :, None] | constant[:, None, :]] = 0
+
+    gram_scaled = np.zeros(grams.shape[:1] + (len(columns) + 1,) * 2)
+    gram_scaled[:, 0, 0] = n
+    gram_scaled[:, 1:, 1:] = standardized[:, :-1, :-1]
+    xty = np.column_stack([np.zeros(len(n)), standardized[:, :-1, -1]])
+    model_stats = ridge_ols_from_gram(gram_scaled, xty, standardized[:, -1, -1], alpha)
+
+    windows = [f"{start}-{start + window - 1}" for start in window_starts]
+    y_means, y_scales = means[:, -1] + offsets[-1], scales[:, -1]
+    features_of_interest = {
+        label: significant_coefficients(
+            ['const'] + columns, model_stats["params"][i], model_stats["pvalues"][i], y_means[i], y_scales[i],
+        )
+        for i, label in enumerate(windows)
+    }
+    ridge_coefficients = pd.DataFrame(model_stats["coef"], index=pd.Index(windows, name="window"), columns=columns)
+    return features_of_interest, ridge_coefficients
+
+def ridge_regression_characters_general(df, show_details=False, n_jobs=None, grouped=False):
+    return ridge_regression_by_period(df, ETHNICITY_COLUMNS, show_details, n_jobs, grouped=grouped)
+
 def plot_important_features_only_considering_ethnic_score(features_of_interest):
     # Create DataFrames for character and genre features
     character_df = pd.DataFrame()
@@ -184,106 +530,10 @@ def plot_important_features_only_considering_ethnic_score(features_of_interest):
     plt.tight_layout()
     plt.show()
 
-def ridge_regression_characters(df, show_details=False):
-    period_counts = df['period'].value_counts().sort_index()
-
+def ridge_regression_characters(df, show_details=False, n_jobs=None, grouped=False):
     #drop ethnic score
     df = df.drop(["ethnic_score"], axis=1)
-
-    # Print periods with more than 500 movies
-    valid_periods = period_counts[period_counts > 500].index
-    features_of_interest = {}  # Initialize as dictionary 
-
-    # For each valid period, run a separate regression
-    for period in valid_periods:
-        # Filter data for this period
-        period_data = df[df['period'] == period]
-        
-        # Split data
-        X = period_data.drop(["Movie box office revenue", "period", "Movie release date"], axis=1)
-        y = period_data["Movie box office revenue"]
-        xtrain, xtest, ytrain, ytest = train_test_split(X, y, test_size=0.1, random_state=42, shuffle=True)
-        
-        # Scale features
-        x_scaler = StandardScaler()
-        xtrain = x_scaler.fit_transform(xtrain)
-        xtest = x_scaler.transform(xtest)
-        
-        y_scaler = StandardScaler()
-        ytrain = y_scaler.fit_transform(ytrain.values.reshape(-1, 1)).ravel()
-        
-        # Fit model
-        model = Ridge(alpha=100.0)
-        model.fit(xtrain, ytrain)
-        
-        # Predict and inverse transform
-        ypred = model.predict(xtest)
-        ypred = y_scaler.inverse_transform(ypred.reshape(-1, 1)).ravel()
-        ypred_2 = model.predict(xtrain)
-        #ypred_2 = y_scaler.inverse_transform(ypred_2.reshape(-1, 1)).ravel()
-
-        if show_details:
-            fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(15, 6))
-
-            # Create subplot
-            ax1.scatter(ytest, ypred, alpha=0.6, label="Revenue", color="blue")
-            ax1.plot([ytest.min(), ytest.max()], [ytest.min(), ytest.max()], 'r--', label="Perfect Prediction Line")
-            ax1.set_xscale('log')
-            ax1.set_yscale("log")
-            ax1.set_xlabel("Actual Values")
-            ax1.set_ylabel("Predicted Values")
-            ax1.set_title(f"Period {period} : Test data")
-            ax1.legend()
-
-            ax2.scatter(ytrain, ypred_2, alpha=0.6, label="Revenue", color="blue")
-            ax2.plot([ytrain.min(), ytrain.max()], [ytrain.min(), ytrain.max()], 'r--', label="Perfect Prediction Line")
-            ax2.set_xscale('log')
-            ax2.set_yscale("log")
-            ax2.set_xlabel("Actual Values")
-            ax2.set_ylabel("Predicted Values")
-            ax2.set_title(f"Period {period} : Train data")
-            ax2.legend()
-
-        # Statistical Summary
-        X_with_const = sm.add_constant(xtrain)
-        model_stats = sm.OLS(ytrain, X_with_const).fit()
-        # Create a DataFrame with coefficients and p-values
-        feature_names = ['const'] + list(X.columns)
-        coef_df = pd.DataFrame({
-            'Feature': feature_names,
-            'Coefficient': model_stats.params,
-            'P-value': model_stats.pvalues
-        })
-
-        ###Change code snippet because we dont sort by absolute value anymore
-        coef_df['Abs_Coefficient'] = coef_df['Coefficient']
-        coef_df = coef_df.sort_values('Abs_Coefficient', ascending=False)
-        coef_df = coef_df.drop('Abs_Coefficient', axis=1)
-
-        # Filter for p-value < 0.05 and display
-        significant_features = coef_df[coef_df['P-value'] < 0.05]
-        significant_features = significant_features[significant_features['Feature'] != 'const']
-        # Inverse transform the coefficients to get them back to original scale
-        # Corrected to use x_scaler for inverse transform
-        significant_features['Coefficient'] = y_scaler.inverse_transform(significant_features['Coefficient'].values.reshape(-1, 1)).ravel()
-        features_of_interest[period] = significant_features  # Store in dictionary
-
-        if show_details:
-            # Display period information
-            print(period)
-            print("\nModel Statistics:")
-            print("R-squared:", model_stats.rsquared)
-            print("\nFeature Coefficients and P-values:")
-            print(significant_features)
-
-            plt.tight_layout()
-            plt.show()
-
-    if show_details:
-        # Print the number of movies in each period
-        print("\nNumber of movies in each period:")
-        print(period_counts[valid_periods])
-    return features_of_interest
+    return ridge_regression_by_period(df, show_details=show_details, n_jobs=n_jobs, grouped=grouped)
 
 def plot_important_features(features_of_interest):
     # Create DataFrames for character and genre features
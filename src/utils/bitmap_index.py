@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+
+from src.utils.data_utils import split_tokens
+
+# Number of set bits of each byte value
+POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.int64)
+
+
+class BitmapQuery:
+    """
+    Boolean query on a `BitmapIndex` built with `has`, `years` and `periods`, combined with `&`, `|`
+    and `~`. Evaluating it on an index returns the bitset of the matching rows.
+    """
+
+    def __init__(self, evaluate):
+        self._evaluate = evaluate
+
+    def __call__(self, index):
+        return self._evaluate(index)
+
+    def __and__(self, other):
+        return BitmapQuery(lambda index: self._evaluate(index) & other._evaluate(index))
+
+    def __or__(self, other):
+        return BitmapQuery(lambda index: self._evaluate(index) | other._evaluate(index))
+
+    def __invert__(self):
+        return BitmapQuery(lambda index: ~self._evaluate(index) & index.all_rows)
+
+
+def has(column_name, value=1):
+    """Rows whose column has the value, e.g. `has("Movie genres", "Drama")` or `has("Drama")` for
+    a 0/1 indicator column"""
+    return BitmapQuery(lambda index: index.bitset(column_name, value))
+
+
+def years(start, end):
+    """Rows released between the `start` and `end` years included"""
+    return BitmapQuery(lambda index: index.year_range(start, end))
+
+
+def periods(first, last):
+    """Rows released between the periods `first` and `last` included, e.g. "1985-1989" """
+    return years(int(first[:4]), int(last[-4:]))
+
+
+class BitmapIndex:
+    """
+    Bitmap index over the attributes of the rows of a DataFrame, built once to answer boolean
+    queries (see `BitmapQuery`) without scanning or splitting the columns again.
+
+    Each value of the indexed columns gets the set of the rows having it, stored as a bitset packed
+    8 rows per byte, or as its sorted row positions when the value is rare enough for that to be
+    smaller. Release years are indexed by the cumulative bitsets of the rows released up to each
+    year, so a year range is answered with two bitsets.
+
+    Parameters:
+    ----------
+    df : DataFrame to index. Queries return positions in its rows.
+    list_columns : Columns of comma separated values (e.g. "Movie genres"), indexed per value.
+    value_columns : Columns with a single value per row (e.g. "period", or 0/1 genre indicators).
+    year_column : Column of release years (or dates starting with the year) for year ranges.
+    """
+
+    def __init__(self, df, list_columns=(), value_columns=(), year_column=None, sep=", "):
+        self.n_rows = len(df)
+        self.all_rows = np.packbits(np.ones(self.n_rows, dtype=bool), bitorder="little")
+        self.sets = {}
+        for column_name in list_columns:
+            tokens, lengths = split_tokens(df[column_name], sep)
+            rows = np.repeat(np.arange(self.n_rows), lengths)
+            self._add_column(column_name, tokens.to_numpy(zero_copy_only=False), rows)
+        for column_name in value_columns:
+            values = df[column_name].to_numpy()
+            valid = pd.notna(values)
+            self._add_column(column_name, values[valid], np.flatnonzero(valid))
+
+        self.years = np.array([], dtype=np.int64)
+        self.year_sets = None
+        if year_column is not None:
+            release_years = pd.to_numeric(df[year_column].astype(str).str[:4], errors="coerce").to_numpy()
+            self.years = np.unique(release_years[~np.isnan(release_years)]).astype(np.int64)
+            if len(self.years):
+                self.year_sets = np.stack([
+                    np.packbits(release_years <= year, bitorder="little") for year in self.years
+                ])
+
+    def _add_column(self, column_name, values, rows):
+        """Index the rows of each value of a column"""
+        codes, uniques = pd.factorize(values)
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+        for code, value in enumerate(uniques):
+            positions = np.unique(rows[order[bounds[code]:bounds[code + 1]]])
+            # Positions take 4 bytes per row against 1 bit per indexed row for a bitset
+            if len(positions) * 32 < self.n_rows:
+                self.sets[column_name, value] = positions.astype(np.uint32)
+            else:
+                self.sets[column_name, value] = self._pack(positions)
+
+    def _pack(self, positions):
+        """Bitset of the given row positions"""
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[positions] = True
+        return np.packbits(mask, bitorder="little")
+
+    def bitset(self, column_name, value):
+        """Bitset of the rows whose column has the value"""
+        rows = self.sets.get((column_name, value))
+        if rows is None:
+            return np.zeros_like(self.all_rows)
+        return self._pack(rows) if rows.dtype == np.uint32 else rows
+
+    def year_range(self, start, end):
+        """Bitset of the rows released between the `start` and `end` years included"""
+        last = np.searchsorted(self.years, end, side="right") - 1
+        before = np.searchsorted(self.years, start, side="left") - 1
+        if last < 0 or last <= before:
+            return np.zeros_like(self.all_rows)
+        if before < 0:
+            return self.year_sets[last]
+        return self.year_sets[last] & ~self.year_sets[before]
+
+    def values(self, column_name):
+        """Indexed values of a column"""
+        return [value for column, value in self.sets if column == column_name]
+
+    def mask(self, query):
+        """Boolean mask of the rows matching the query"""
+        return np.unpackbits(query(self), count=self.n_rows, bitorder="little").astype(bool)
+
+    def positions(self, query):
+        """Positions of the rows matching the query, e.g. for `df.iloc[index.positions(query)]`"""
+        return np.flatnonzero(self.mask(query))
+
+    def count(self, query):
+        """Number of rows matching the query"""
+        return int(POPCOUNT[query(self)].sum())
@@ -1,5 +1,15 @@
+import asyncio
+import json
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute
+import scipy.sparse as sp
+import sqlite3
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 import requests
 
 ethnicity_mapping = {
@@ -221,120 +231,805 @@ def reorder_column(df: pd.DataFrame, col_name: str, index: int) -> pd.DataFrame:
     cols.insert(index, col_name)
     return df[cols]
 
-def get_revenue(wikidata_id):
-    """Get the movie revenue from the wikidata id"""
-    url = "https://www.wikidata.org/w/api.php"
-    params = {
-        "action": "wbgetentities",
-        "ids": wikidata_id,
-        "format": "json",
-        "languages": "en",
-    }
+def decode_json_dict_column(series: pd.Series):
+    """
+    Decode a column of JSON dictionaries such as '{"/m/02h40lc": "English Language"}' in one pass.
+
+    The raw strings are split into their "key": "value" pairs and the pairs into keys and values
+    with Arrow string kernels over the whole column, so no dictionary or string is built per row.
+    Only the keys and values with escape sequences (e.g. "\\u00e9") are decoded by `json.loads`.
+    The rows that are not framed exactly like the example (other spacing, escaped quotes, ...)
+    cannot be split this way and are parsed with a single `json.loads` call instead.
+
+    The result is returned as flat arrays with row offsets: the keys and values of row i are
+    `keys[offsets[i]:offsets[i + 1]]` and `values[offsets[i]:offsets[i + 1]]`.
+    Missing rows are decoded as empty dictionaries.
+
+    Returns:
+    -------
+    keys : Object array with the (Freebase ID) keys of all rows.
+    values : Object array with the (name) values of all rows.
+    offsets : Integer array of length len(series) + 1 with the start of each row.
+    """
+    raw = pa.array(series.fillna("{}"), type=pa.string())
+    n_rows = len(raw)
+
+    # '{"k1": "v1", "k2": "v2"}' is split into 'k1": "v1' and 'k2": "v2', and then into keys and
+    # values. A row is only decoded this way when it has this framing and each of its pieces is
+    # exactly one key and one value
+    pieces = pa.compute.split_pattern(pa.compute.utf8_slice_codeunits(raw, 2, -2), '", "')
+    pairs = pa.compute.split_pattern(pa.compute.list_flatten(pieces), '": "')
+    rows = np.repeat(np.arange(n_rows), pa.compute.list_value_length(pieces).to_numpy())
+    is_pair = pa.compute.equal(pa.compute.list_value_length(pairs), 2).to_numpy(zero_copy_only=False)
+    empty = pa.compute.equal(raw, "{}").to_numpy(zero_copy_only=False)
+    framed = pa.compute.and_(
+        pa.compute.starts_with(raw, '{"'), pa.compute.ends_with(raw, '"}')
+    ).to_numpy(zero_copy_only=False)
+    has_escapes = pa.compute.any(pa.compute.match_substring(raw, "\\")).as_py()
+    if has_escapes:
+        framed &= ~pa.compute.match_substring(raw, '\\"').to_numpy(zero_copy_only=False)
+    split = framed & (np.bincount(rows[~is_pair], minlength=n_rows) == 0)
+    # The single empty piece of an empty dictionary is dropped
+    kept = split[rows]
+    if not kept.all():
+        pairs = pairs.filter(kept)
+
+    def unescape(strings):
+        decoded = strings.to_numpy(zero_copy_only=False)
+        if not has_escapes:
+            return decoded
+        escaped = pa.compute.match_substring(strings, "\\").to_numpy(zero_copy_only=False)
+        if escaped.any():
+            decoded[escaped] = json.loads("[" + ",".join('"' + text + '"' for text in decoded[escaped]) + "]")
+        return decoded
+
+    parsed = ~(split | empty)
+    records = json.loads("[" + ",".join(raw.filter(parsed).to_pylist()) + "]")
+    counts = np.bincount(rows[kept], minlength=n_rows)
+    counts[parsed] = np.fromiter(map(len, records), dtype=np.int64, count=len(records))
+    offsets = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    # Merge the pairs of both kinds of rows in row order
+    from_records = np.repeat(parsed, counts)
+    keys = np.empty(offsets[-1], dtype=object)
+    values = np.empty(offsets[-1], dtype=object)
+    keys[~from_records] = unescape(pa.compute.list_element(pairs, 0))
+    values[~from_records] = unescape(pa.compute.list_element(pairs, 1))
+    keys[from_records] = list(chain.from_iterable(map(dict.keys, records)))
+    values[from_records] = list(chain.from_iterable(map(dict.values, records)))
+    return keys, values, offsets
+
+def join_ragged(values, offsets, sep=", "):
+    """
+    Join the values of each row of a ragged array (flat values with row offsets) into strings,
+    with a single Arrow join over all the rows
+    """
+    values = np.asarray(values)
+    if values.dtype != object:
+        values = np.array(list(map(str, values)), dtype=object)
+    lists = pa.ListArray.from_arrays(
+        pa.array(np.asarray(offsets), type=pa.int32()), pa.array(values, type=pa.string())
+    )
+    return pa.compute.binary_join(lists, sep).to_numpy(zero_copy_only=False)
+
+def group_to_lists(codes, n_groups, values) -> pd.Series:
+    """
+    Gather the non-missing values of each group into a list column, in their order of appearance.
+
+    The lists are stored as an Arrow list array (flat values with offsets) so no Python list is built
+    per group. `codes` gives the group (0 to n_groups - 1) of each value.
+    """
+    values = pd.Series(values)
+    valid = values.notna().to_numpy()
+    codes = np.asarray(codes)[valid]
+    order = np.argsort(codes, kind="stable")
+    offsets = np.zeros(n_groups + 1, dtype=np.int32)
+    np.cumsum(np.bincount(codes, minlength=n_groups), out=offsets[1:])
+    value_type = pa.string() if values.dtype == object else None
+    flat_values = pa.array(values.to_numpy()[valid][order], type=value_type)
+    lists = pa.ListArray.from_arrays(pa.array(offsets), flat_values)
+    return pd.Series(lists, dtype=pd.ArrowDtype(lists.type))
+
+def to_list_array(lists: pd.Series) -> pa.ListArray:
+    """Get the Arrow list array behind a list column"""
+    lists = pa.array(lists)
+    return lists.combine_chunks() if isinstance(lists, pa.ChunkedArray) else lists
+
+def regroup_lists(codes, n_groups, lists: pd.Series) -> pd.Series:
+    """Concatenate the lists of a list column that belong to the same group"""
+    lists = to_list_array(lists)
+    lengths = pa.compute.list_value_length(lists).to_numpy(zero_copy_only=False)
+    return group_to_lists(
+        np.repeat(codes, lengths), n_groups, lists.flatten().to_numpy(zero_copy_only=False)
+    )
+
+def join_lists(lists: pd.Series, sep=", ") -> np.ndarray:
+    """Join the values of each list of a list column into strings"""
+    lists = to_list_array(lists)
+    offsets = lists.offsets.to_numpy()
+    return join_ragged(lists.flatten().to_numpy(zero_copy_only=False), offsets - offsets[0], sep)
+
+def normalize_title(titles: pd.Series) -> pd.Series:
+    """Normalize movie titles for matching: case-folded, without surrounding or repeated whitespace"""
+    return titles.str.casefold().str.strip().str.replace(r"\s+", " ", regex=True)
+
+def first_match(keys: pd.Series, candidates: pd.Series) -> np.ndarray:
+    """Find the position of the first candidate equal to each key, or -1 when there is none"""
+    first = candidates.reset_index(drop=True).dropna().drop_duplicates()
+    positions = pd.Index(first).get_indexer(keys)
+    return np.where(positions >= 0, first.index.to_numpy()[positions], -1)
+
+WIKIDATA_API_URL = "https://www.wikidata.org/w/api.php"
+
+# HTTP statuses of transient failures worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def parse_revenue(entity):
+    """Get the box office revenue stored in the wikidata item P2142 of a wbgetentities entity"""
     try:
-        # Request the data from the wikidata API
-        response = requests.get(url, params=params)
-        data = response.json()
-        if "entities" in data and wikidata_id in data["entities"]:
-            claims = data["entities"][wikidata_id]["claims"]
-            # Get the box office revenue claim stored in the wikidata item P2142
-            if "P2142" in claims:
-                box_office_claim = claims["P2142"][0]["mainsnak"]["datavalue"]["value"]
-                return float(box_office_claim["amount"])
-            else:
-                return None
-        else:
-            return None
-    except requests.exceptions.RequestException:
+        box_office_claim = entity["claims"]["P2142"][0]["mainsnak"]["datavalue"]["value"]
+        return float(box_office_claim["amount"])
+    except (KeyError, IndexError, TypeError, ValueError):
         return None
 
-def update_movie_revenue(movie_df):
-    """Update the movie revenue for movies having a missing revenue"""
-    def process_row(index, row):
-        """Process a row to update the movie revenue"""
-        if pd.notna(row["Movie box office revenue"]):
-            return index, row["Movie box office revenue"]
-
-        revenue = get_revenue(row["wikidata_movie_id"])
-        if revenue == 0:
-            revenue = None
-        return index, revenue
-
-    # Create a thread pool executor
-    with ThreadPoolExecutor() as executor:
-        # Submit tasks to the thread pool
-        futures = {
-            executor.submit(process_row, index, row): index
-            for index, row in movie_df.iterrows()
+class RevenueCache:
+    """
+    Persistent SQLite store of the revenues fetched from Wikidata, keyed by wikidata id.
+
+    Both the amounts and the negative results (ids without a revenue) are stored with the time they
+    were fetched, and entries older than `ttl` seconds are considered missing (they never expire
+    when `ttl` is None). Failed requests are not stored, so they are retried on the next run.
+    """
+
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS revenues "
+                "(wikidata_id TEXT PRIMARY KEY, revenue REAL, fetched_at REAL NOT NULL)"
+            )
+
+    def get(self, wikidata_ids):
+        """Get the stored revenues that have not expired, None for the stored negative results"""
+        oldest = 0 if self.ttl is None else time.time() - self.ttl
+        wikidata_ids = list(wikidata_ids)
+        revenues = {}
+        with self._lock:
+            # Query the ids in chunks below the SQLite limit on the number of parameters
+            for i in range(0, len(wikidata_ids), 900):
+                chunk = wikidata_ids[i:i + 900]
+                rows = self._connection.execute(
+                    f"SELECT wikidata_id, revenue FROM revenues "
+                    f"WHERE fetched_at >= ? AND wikidata_id IN ({', '.join('?' * len(chunk))})",
+                    [oldest] + chunk,
+                )
+                revenues.update(rows)
+        return revenues
+
+    def put(self, revenues):
+        """Store fetched revenues, None for the ids without a revenue"""
+        fetched_at = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO revenues VALUES (?, ?, ?)",
+                [(wikidata_id, revenue, fetched_at) for wikidata_id, revenue in revenues.items()],
+            )
+
+    def close(self):
+        self._connection.close()
+
+class WikidataRevenueClient:
+    """
+    Client fetching movie revenues from the Wikidata API in batches.
+
+    The IDs are requested `batch_size` at a time (50 is the wbgetentities limit) over a pooled
+    keep-alive session, with at most `max_requests_per_second` requests started per second across
+    all the threads and tasks. `base_url` can point to a local stub server instead of Wikidata.
+    With a `RevenueCache`, the stored revenues are not requested again and every batch is stored
+    as soon as it is fetched, so an interrupted backfill resumes where it stopped.
+    The ids whose requests failed in the last call are kept in `failed_ids`.
+
+    `max_workers` threads request the batches of `get_revenues`, and `concurrency` requests are in
+    flight at once in the asynchronous methods unless they are given another limit. The session
+    keeps a connection for each of them.
+    """
+
+    def __init__(self, base_url=WIKIDATA_API_URL, batch_size=50, max_requests_per_second=5,
+                 max_workers=4, timeout=30, session=None, cache=None, concurrency=8):
+        self.base_url = base_url
+        self.batch_size = batch_size
+        self.max_requests_per_second = max_requests_per_second
+        self.max_workers = max_workers
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._pool_size = None
+        if session is None:
+            session = requests.Session()
+            self._pool_size = 0
+        self.session = session
+        self._reserve_connections(max(max_workers, concurrency))
+        self.cache = cache
+        self.failed_ids = []
+        self._lock = threading.Lock()
+        self._next_request = 0.0
+
+    def _reserve_connections(self, count):
+        """Keep at least `count` connections in the pool of the session created by the client"""
+        if self._pool_size is None or self._pool_size >= count:
+            return
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=count)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._pool_size = count
+
+    def _rate_limit_delay(self):
+        """Reserve the next request allowed by the rate limit and return how long to wait for it"""
+        if not self.max_requests_per_second:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_request)
+            self._next_request = start + 1 / self.max_requests_per_second
+        return start - now
+
+    def _request(self, wikidata_ids):
+        """Request the entities of the given wikidata ids in a single wbgetentities call"""
+        params = {
+            "action": "wbgetentities",
+            "ids": "|".join(wikidata_ids),
+            "format": "json",
+            "props": "claims",
         }
+        return self.session.get(self.base_url, params=params, timeout=self.timeout)
+
+    def _batches(self, wikidata_ids):
+        """
+        Split the distinct ids to request into batches. Returns the revenues known without a
+        request: None for the ids that are not item ids, and the revenues stored in the cache.
+        """
+        ids = pd.unique(pd.Series(wikidata_ids, dtype=object).dropna())
+        # Ids that are not item ids would fail their whole batch
+        valid = [wikidata_id for wikidata_id in ids if str(wikidata_id).startswith("Q")]
+        known = dict.fromkeys(set(ids).difference(valid))
+        if self.cache is not None:
+            known.update(self.cache.get(valid))
+            valid = [wikidata_id for wikidata_id in valid if wikidata_id not in known]
+        batches = [valid[i:i + self.batch_size] for i in range(0, len(valid), self.batch_size)]
+        return known, batches
+
+    def _store(self, batch, batch_revenues):
+        """Record a fetched batch: the ids it did not resolve failed, the others are cached"""
+        self.failed_ids.extend(wikidata_id for wikidata_id in batch if wikidata_id not in batch_revenues)
+        if self.cache is not None and batch_revenues:
+            self.cache.put(batch_revenues)
+
+    @staticmethod
+    def _parse_batch(data, wikidata_ids):
+        """Get the revenues of a batch from the wbgetentities response"""
+        entities = data.get("entities", {})
+        return {wikidata_id: parse_revenue(entities.get(wikidata_id)) for wikidata_id in wikidata_ids}
+
+    def _get_batch(self, wikidata_ids):
+        """Get the revenues of a batch of wikidata ids, without the ids whose request failed"""
+        time.sleep(self._rate_limit_delay())
+        try:
+            response = self._request(wikidata_ids)
+            response.raise_for_status()
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError):
+            return {}
+
+        # A single unknown id fails the whole batch, so retry the ids one by one
+        if "error" in data and len(wikidata_ids) > 1:
+            revenues = {}
+            for wikidata_id in wikidata_ids:
+                revenues.update(self._get_batch([wikidata_id]))
+            return revenues
+        return self._parse_batch(data, wikidata_ids)
+
+    def get_revenues(self, wikidata_ids):
+        """Get the revenue of each distinct wikidata id, None when it has none or the request failed"""
+        revenues, batches = self._batches(wikidata_ids)
+        self.failed_ids = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for batch, batch_revenues in zip(batches, executor.map(self._get_batch, batches)):
+                self._store(batch, batch_revenues)
+                revenues.update(dict.fromkeys(batch))
+                revenues.update(batch_revenues)
+        return revenues
+
+    def get_revenue(self, wikidata_id):
+        """Get the movie revenue from the wikidata id"""
+        return self.get_revenues([wikidata_id]).get(wikidata_id)
+
+    async def _get_batch_async(self, wikidata_ids, semaphore, executor, max_retries, backoff):
+        """
+        Get the revenues of a batch of wikidata ids, retrying transient failures (timeouts,
+        connection errors, 429 and 5xx responses) with exponential backoff. The ids whose batch
+        still fails after `max_retries` retries, or fails with another error, are left out.
+        """
+        for attempt in range(max_retries + 1):
+            async with semaphore:
+                await asyncio.sleep(self._rate_limit_delay())
+                try:
+                    # The blocking request runs on the client's threads, one per allowed request
+                    response = await asyncio.get_running_loop().run_in_executor(
+                        executor, self._request, wikidata_ids
+                    )
+                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                    response = None
+                except requests.exceptions.RequestException:
+                    # e.g. a truncated response, which fails the batch as in `_get_batch`
+                    return {}
+
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                break
+            if attempt == max_retries:
+                return {}
+            # Wait as long as the server asks for, or exponentially longer after each failure
+            retry_after = response.headers.get("Retry-After") if response is not None else None
+            delay = float(retry_after) if str(retry_after).isdigit() else backoff * 2 ** attempt
+            await asyncio.sleep(delay)
+
+        try:
+            response.raise_for_status()
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError):
+            return {}
+
+        # A single unknown id fails the whole batch, so retry the ids one by one
+        if "error" in data and len(wikidata_ids) > 1:
+            revenues = {}
+            for batch_revenues in await asyncio.gather(*(
+                self._get_batch_async([wikidata_id], semaphore, executor, max_retries, backoff)
+                for wikidata_id in wikidata_ids
+            )):
+                revenues.update(batch_revenues)
+            return revenues
+        return self._parse_batch(data, wikidata_ids)
+
+    async def iter_revenues_async(self, wikidata_ids, concurrency=None, max_retries=5, backoff=1.0):
+        """
+        Get the revenues of the distinct wikidata ids batch by batch, as the batches complete.
+
+        At most `concurrency` requests (the client's `concurrency` by default) are in flight at
+        once, each on its own thread. Yields a dictionary of revenues per
+        batch, starting with the revenues known without a request. The ids that still fail after
+        `max_retries` retries are not yielded but recorded in `failed_ids`, so they can be
+        requested again later.
+        """
+        known, batches = self._batches(wikidata_ids)
+        self.failed_ids = []
+        yield known
+
+        concurrency = concurrency or self.concurrency
+        self._reserve_connections(concurrency)
+        semaphore = asyncio.Semaphore(concurrency)
+        # The default executor of the loop would bound the requests by its own number of threads
+        executor = ThreadPoolExecutor(concurrency)
+
+        async def get_batch(batch):
+            return batch, await self._get_batch_async(batch, semaphore, executor, max_retries, backoff)
+
+        tasks = [asyncio.ensure_future(get_batch(batch)) for batch in batches]
+        try:
+            for completed in asyncio.as_completed(tasks):
+                batch, batch_revenues = await completed
+                self._store(batch, batch_revenues)
+                yield batch_revenues
+        finally:
+            # Stop the remaining requests if the caller stops early
+            for task in tasks:
+                task.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
 
-        # Wait for each future to complete and update the DataFrame
-        for future in futures:
-            index, revenue = future.result()
-            movie_df.at[index, "Movie box office revenue"] = revenue
+    async def get_revenues_async(self, wikidata_ids, concurrency=None, max_retries=5, backoff=1.0):
+        """Asynchronous `get_revenues` with retries, see `iter_revenues_async`"""
+        revenues = {}
+        async for batch_revenues in self.iter_revenues_async(wikidata_ids, concurrency, max_retries, backoff):
+            revenues.update(batch_revenues)
+        revenues.update(dict.fromkeys(self.failed_ids))
+        return revenues
 
+def get_revenue(wikidata_id, client=None):
+    """Get the movie revenue from the wikidata id"""
+    return (client or WikidataRevenueClient()).get_revenue(wikidata_id)
+
+def rows_by_id(positions, wikidata_ids):
+    """Group the row positions by wikidata id"""
+    return pd.Series(positions).groupby(wikidata_ids.to_numpy()).agg(list).to_dict()
+
+def set_revenues(movie_df, rows, revenues):
+    """Set the revenues of the given wikidata ids on their rows, given as positions per id"""
+    column = movie_df.columns.get_loc("Movie box office revenue")
+    revenues = {wikidata_id: revenue for wikidata_id, revenue in revenues.items() if wikidata_id in rows}
+    positions = [rows[wikidata_id] for wikidata_id in revenues]
+    if not positions:
+        return
+    values = np.repeat(
+        np.array(list(revenues.values()), dtype=float), [len(position) for position in positions]
+    )
+    # A revenue of 0 is not a valid revenue
+    movie_df.iloc[np.concatenate(positions), column] = np.where(values != 0, values, np.nan)
+
+def update_movie_revenue(movie_df, client=None):
+    """
+    Update the movie revenue for movies having a missing revenue.
+    Pass a client with a cache, e.g. `WikidataRevenueClient(cache=RevenueCache("revenues.sqlite"))`,
+    to reuse the revenues fetched by previous runs.
+    """
+    client = client or WikidataRevenueClient()
+    missing = np.flatnonzero(movie_df["Movie box office revenue"].isna())
+    wikidata_ids = movie_df["wikidata_movie_id"].iloc[missing]
+
+    # Request each distinct missing id once, in batches
+    revenues = client.get_revenues(wikidata_ids)
+    set_revenues(movie_df, rows_by_id(missing, wikidata_ids), revenues)
+    return movie_df
+
+async def update_movie_revenue_async(movie_df, client=None, concurrency=None, max_retries=5, backoff=1.0):
+    """
+    Asynchronous `update_movie_revenue`, e.g. `await update_movie_revenue_async(df)` in a notebook.
+
+    Up to `concurrency` batches (the client's `concurrency` by default) are requested at once,
+    retrying timeouts, 429 and 5xx responses with exponential backoff starting at `backoff` seconds,
+    and each batch is written to `movie_df` as soon as it completes, so the revenues fetched so far are kept if the update is interrupted.
+    The ids that still failed are in `client.failed_ids` and keep a missing revenue.
+    """
+    client = client or WikidataRevenueClient()
+    missing = np.flatnonzero(movie_df["Movie box office revenue"].isna())
+    wikidata_ids = movie_df["wikidata_movie_id"].iloc[missing]
+    rows = rows_by_id(missing, wikidata_ids)
+
+    async for revenues in client.iter_revenues_async(wikidata_ids, concurrency, max_retries, backoff):
+        set_revenues(movie_df, rows, revenues)
     return movie_df
 
 def reduce_genres_and_ethnicities(df, genre_mapping=genre_mapping, ethnicity_mapping=ethnicity_mapping):
     """Reduce the number of genres and ethnicities columns in the DataFrame using a mapping dictionary to more general categories"""
-    df = create_dummies_from_list_column(df, 'ethnicity')
-    df = create_dummies_from_list_column(df, 'Movie genres')
-    ethnicity_columns = [col for col in df.columns if col.lower().startswith('ethnicity')]
-    genre_columns = [col for col in df.columns if col.lower().startswith('movie genres')]
-
-    # Create new columns for each category
-    for category, columns in ethnicity_mapping.items():
-        existing_columns = [col for col in columns if col in df.columns]
-        if existing_columns:
-            df[category] = df[existing_columns].sum(axis=1)
-
-    for category, genres in genre_mapping.items():
-        existing_columns = [col for col in genres if col in df.columns]
-        if existing_columns:
-            df[category] = df[existing_columns].sum(axis=1)
-            df[category] = df[category].apply(lambda x: 1 if x > 1 else x)
-
-    df['Movie genres'] = df[genre_mapping.keys()].apply(
-        lambda row: ', '.join([category for category in genre_mapping.keys() if row[category] == 1]), axis=1
-    )
-    df['ethnicity'] = df[ethnicity_mapping.keys()].apply(
-        lambda row: ', '.join([category for category in ethnicity_mapping.keys() if row[category] > 0]), axis=1
+    # Count the categories of each row with a single sparse product of its values and the mapping
+    genre_encoder, genre_matrix = compile_category_mapping(genre_mapping, 'Movie genres')
+    ethnicity_encoder, ethnicity_matrix = compile_category_mapping(ethnicity_mapping, 'ethnicity')
+    genres = (genre_encoder.transform(df['Movie genres']) @ genre_matrix).toarray()
+    ethnicities = (ethnicity_encoder.transform(df['ethnicity']) @ ethnicity_matrix).toarray()
+
+    # A movie has a genre category if it has any of its genres
+    genres = np.clip(genres, 0, 1)
+    return df.drop(columns=['ethnicity', 'Movie genres']).assign(**{
+        'Movie genres': category_labels(genres == 1, list(genre_mapping)),
+        'ethnicity': category_labels(ethnicities > 0, list(ethnicity_mapping)),
+    })
+
+def compile_category_mapping(mapping, prefix):
+    """
+    Compile a {category: ["{prefix}_{value}", ...]} mapping into an encoder of the mapped values and
+    a sparse 0/1 matrix of shape (values, categories), so that the product of the encoded values
+    and the matrix counts the values of each category.
+    """
+    columns = list(chain.from_iterable(mapping.values()))
+    values = sorted({column[len(prefix) + 1:] for column in columns if column.startswith(f"{prefix}_")})
+    encoder = MultiHotEncoder(vocabulary=values)
+    rows = pd.Index(encoder.feature_names(prefix)).get_indexer(columns)
+    categories = np.repeat(np.arange(len(mapping)), [len(columns) for columns in mapping.values()])
+    mapped = rows >= 0
+    matrix = sp.csr_matrix(
+        (np.ones(mapped.sum(), dtype=np.int64), (rows[mapped], categories[mapped])),
+        shape=(len(values), len(mapping)),
     )
+    return encoder, matrix
 
-    # Drop the grouped ethnicity and genre columns used for intermediate calculations
-    df = df.drop(columns=list(ethnicity_mapping.keys()) + list(genre_mapping.keys()), axis=1)
+def category_labels(indicators, categories, sep=", "):
+    """Join the names of the categories indicated on each row of a boolean (rows, categories) matrix"""
+    if len(indicators) == 0:
+        return np.array([], dtype=object)
+    # Build the label of each distinct combination of categories once
+    combinations, inverse = np.unique(indicators, axis=0, return_inverse=True)
+    categories = np.array(categories, dtype=object)
+    labels = np.array([sep.join(categories[combination]) for combination in combinations], dtype=object)
+    return labels[inverse.reshape(-1)]
 
-    # Drop the original ethnicity columns
-    df = df.drop(columns=ethnicity_columns, axis=1)
-    df = df.drop(columns=genre_columns, axis=1)
-    return df
+def split_tokens(series, sep=", "):
+    """
+    Split a column of separated values in one vectorized pass into a flat Arrow array of tokens
+    and the number of tokens of each row (0 for missing rows).
+    """
+    values = pa.array(series.to_numpy(dtype=object), type=pa.string(), from_pandas=True)
+    lists = pa.compute.split_pattern(values, sep)
+    lengths = pa.compute.list_value_length(lists).fill_null(0).to_numpy()
+    return lists.flatten(), lengths
+
+class TokenFilter:
+    """
+    Row filter on list columns built with `has_token`, combined with `&`, `|` and `~`.
+    Calling it on a DataFrame returns the boolean mask of the matching rows, splitting each list
+    column only once however many predicates use it.
+    """
+
+    def __init__(self, evaluate):
+        self._evaluate = evaluate
+
+    def __call__(self, df):
+        return self._evaluate(df, {})
+
+    def __and__(self, other):
+        return TokenFilter(lambda df, tokens: self._evaluate(df, tokens) & other._evaluate(df, tokens))
+
+    def __or__(self, other):
+        return TokenFilter(lambda df, tokens: self._evaluate(df, tokens) | other._evaluate(df, tokens))
+
+    def __invert__(self):
+        return TokenFilter(lambda df, tokens: ~self._evaluate(df, tokens))
+
+def has_token(column_name, token, times=None, sep=", "):
+    """
+    Filter the rows of a list column such as "Drama, Comedy" containing a token, at least once or
+    exactly `times` times, without building dummy variables.
+    e.g. `df[(has_token("Movie genres", "Drama") & ~has_token("Movie genres", "Comedy"))(df)]`
+    """
+
+    def evaluate(df, tokens):
+        if (column_name, sep) not in tokens:
+            flat_tokens, lengths = split_tokens(df[column_name], sep)
+            tokens[column_name, sep] = flat_tokens, np.repeat(np.arange(len(df)), lengths)
+        flat_tokens, rows = tokens[column_name, sep]
+        matches = pa.compute.equal(flat_tokens, token).to_numpy(zero_copy_only=False)
+        counts = np.bincount(rows[matches], minlength=len(df))
+        return counts >= 1 if times is None else counts == times
+
+    return TokenFilter(evaluate)
+
+class MultiHotEncoder:
+    """
+    Multi-hot encoder of a column containing lists of separated values such as "Drama, Comedy".
+
+    `fit` builds the sorted vocabulary of the values, and `transform` counts the occurrences of each
+    vocabulary value per row into a `scipy.sparse` CSR matrix (values outside the vocabulary are
+    ignored), so a saved vocabulary can encode new data with the same columns. The column is
+    tokenized in a single vectorized pass on its Arrow representation, without a list per row.
+    """
+
+    def __init__(self, sep=", ", vocabulary=None):
+        self.sep = sep
+        self.vocabulary = None if vocabulary is None else list(vocabulary)
+
+    def _tokenize(self, series):
+        """Split all the rows at once into flat tokens with the number of tokens per row"""
+        tokens, lengths = split_tokens(series, self.sep)
+        return tokens.to_numpy(zero_copy_only=False), lengths
+
+    def fit(self, series):
+        """Build the vocabulary of the values of the column"""
+        tokens, _ = self._tokenize(series)
+        self.vocabulary = sorted(set(tokens))
+        return self
 
-def create_dummies_from_list_column(df, column_name):
-    """Create dummy variables from a column containing lists of comma separated values"""
-    # Split the string entries into lists
-    split_series = df[column_name].str.split(', ')
-    # Create a new DataFrame with dummy variables
-    dummy_df = pd.get_dummies(split_series.apply(pd.Series).stack(), prefix=column_name).groupby(level=0).sum()
+    def transform(self, series):
+        """Count the vocabulary values of each row into a CSR matrix of shape (rows, vocabulary)"""
+        tokens, lengths = self._tokenize(series)
+        codes = pd.Index(self.vocabulary).get_indexer(tokens)
+        rows = np.repeat(np.arange(len(series)), lengths)
+        known = codes >= 0
+        return sp.csr_matrix(
+            (np.ones(known.sum(), dtype=np.int64), (rows[known], codes[known])),
+            shape=(len(series), len(self.vocabulary)),
+        )
+
+    def fit_transform(self, series):
+        return self.fit(series).transform(series)
+
+    def feature_names(self, prefix):
+        return [f"{prefix}_{value}" for value in self.vocabulary]
+
+    def transform_frame(self, series, prefix=None, sparse=False):
+        """
+        Encode the column as a DataFrame with one `{prefix}_{value}` column per vocabulary value,
+        with sparse pandas columns when `sparse` is set. The rows of missing values are NaN.
+        """
+        matrix = self.transform(series)
+        columns = self.feature_names(series.name if prefix is None else prefix)
+        missing = series.isna().to_numpy()
+        if sparse:
+            if missing.any():
+                # Store the NaN of the missing rows explicitly
+                missing_rows = np.flatnonzero(missing)
+                n_columns = matrix.shape[1]
+                matrix = matrix.astype(float) + sp.csr_matrix(
+                    (
+                        np.full(len(missing_rows) * n_columns, np.nan),
+                        (np.repeat(missing_rows, n_columns), np.tile(np.arange(n_columns), len(missing_rows))),
+                    ),
+                    shape=matrix.shape,
+                )
+            return pd.DataFrame.sparse.from_spmatrix(matrix, index=series.index, columns=columns)
+        dense = matrix.toarray()
+        if missing.any():
+            dense = dense.astype(float)
+            dense[missing] = np.nan
+        return pd.DataFrame(dense, index=series.index, columns=columns)
+
+def create_dummies_from_list_column(df, column_name, encoder=None):
+    """
+    Create dummy variables from a column containing lists of comma separated values.
+    The values are counted with a `MultiHotEncoder`, fitted on the column unless a fitted `encoder`
+    is given.
+    """
+    encoder = encoder or MultiHotEncoder().fit(df[column_name])
+    dummy_df = encoder.transform_frame(df[column_name])
     # Merge the dummy variables into the original DataFrame
     df = pd.concat([df, dummy_df], axis=1)
     # Drop the original column
     df = df.drop(column_name, axis=1)
     return df
 
-def replace_with_min_max(df, column_name):
-    """Replace a column containing lists of comma separated values with the minimum and maximum values"""
-    # Split the ages into lists, cleaning up any whitespace or invalid entries
-    df[column_name] = df[column_name].str.split(', ').apply(
-        lambda x: [float(age.strip()) for age in x if age.strip().replace('.', '', 1).isdigit()]
-    )
-    df[f'{column_name}_min'] = df[column_name].apply(
-        lambda x: min(x) if len(x) > 0 else None
-    )
-    df[f'{column_name}_max'] = df[column_name].apply(
-        lambda x: max(x) if len(x) > 0 else None
-    )
+def parse_ragged_numbers(series, sep=", "):
+    """
+    Parse a column of separated non-negative numbers such as "1.75, 1.8" into flat floats with row
+    offsets, in one vectorized pass: the numbers of row i are `values[offsets[i]:offsets[i + 1]]`.
+    Entries that are not numbers (e.g. "", "nan") and missing rows are skipped.
+    """
+    tokens, lengths = split_tokens(series, sep)
+    tokens = pa.compute.utf8_trim_whitespace(tokens)
+    # Digits with at most one decimal point
+    valid = pa.compute.match_substring_regex(tokens, r"^(\d+\.?\d*|\.\d+)$").to_numpy(zero_copy_only=False)
+    rows = np.repeat(np.arange(len(series)), lengths)[valid]
+    numbers = tokens.filter(pa.array(valid)).to_numpy(zero_copy_only=False).astype(float)
+    offsets = np.zeros(len(series) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(series)), out=offsets[1:])
+    return numbers, offsets
+
+def ragged_stats(values, offsets, stats=("min", "max")):
+    """
+    Compute statistics of each row of a ragged array (flat values with row offsets) with
+    reductions over contiguous segments. Available statistics are "min", "max", "count", "mean"
+    and "std" (population standard deviation); they are NaN for empty rows.
+    """
+    counts = np.diff(offsets)
+    nonempty = counts > 0
+    starts = offsets[:-1][nonempty]
+    results = {}
+    for stat in stats:
+        result = np.full(len(counts), np.nan)
+        if stat == "count":
+            result = counts
+        elif len(starts) and stat == "min":
+            result[nonempty] = np.minimum.reduceat(values, starts)
+        elif len(starts) and stat == "max":
+            result[nonempty] = np.maximum.reduceat(values, starts)
+        elif len(starts) and stat in ("mean", "std"):
+            mean = np.add.reduceat(values, starts) / counts[nonempty]
+            if stat == "mean":
+                result[nonempty] = mean
+            else:
+                mean_of_squares = np.add.reduceat(values * values, starts) / counts[nonempty]
+                result[nonempty] = np.sqrt(np.maximum(mean_of_squares - mean * mean, 0))
+        elif stat not in ("min", "max", "mean", "std"):
+            raise ValueError(f"Unknown statistic: {stat}")
+        results[stat] = result
+    return results
+
+def replace_with_min_max(df, column_name, stats=("min", "max")):
+    """
+    Replace a column containing lists of comma separated values with the minimum and maximum values,
+    or the other `stats` of `ragged_stats` (e.g. ("min", "max", "mean", "std")).
+    """
+    values, offsets = parse_ragged_numbers(df[column_name])
+    columns = {f'{column_name}_{stat}': result for stat, result in ragged_stats(values, offsets, stats).items()}
     # Drop the original column
-    df = df.drop(column_name, axis=1)
-    return df
+    return df.drop(column_name, axis=1).assign(**columns)
+
+ETHNICITY_CATEGORIES = [
+    'African Ethnicities', 'American Ethnicities', 'Asian Ethnicities', 'Eastern European Ethnicities', 'Indigenous Peoples',
+    'Jewish Communities', 'Latin American Ethnicities', 'Middle Eastern and Arab Ethnicities',
+    'Northern European Ethnicities', 'Oceanian Ethnicities', 'Southern European Ethnicities',
+    'Western European Ethnicities'
+]
+
+# Movies produced in the USA in English
+US_ENGLISH_MOVIES = (
+    has_token('Movie countries', 'United States of America', times=1)
+    & has_token('Movie languages', 'English Language', times=1)
+)
+
+class ModelPreprocessor:
+    """
+    Fitted version of `preprocess_data_for_model`.
+
+    `fit` learns the column schema of the features, i.e. the vocabularies of the actor genders,
+    genres and ethnicities in their column order, and `transform` applies the same steps to new
+    movies with the learned encoders, so a new batch gets exactly the columns of the fitted data
+    without reprocessing it. Values absent from the fitted data are ignored.
+    """
+
+    def __init__(self):
+        self.encoders = None
+        self.columns = None
+
+    def fit(self, df):
+        self._process(df, fit=True)
+        return self
+
+    def transform(self, df):
+        if self.encoders is None:
+            raise ValueError("The preprocessor must be fitted before transforming data")
+        return self._process(df, fit=False)
+
+    def fit_transform(self, df):
+        return self._process(df, fit=True)
+
+    def fit_chunks(self, chunks):
+        """
+        Fit on an iterable of DataFrames holding one chunk in memory at a time, learning the same
+        vocabularies as `fit` on their concatenation.
+        """
+        vocabularies = {column_name: set() for column_name in ('actor_gender', 'Movie genres', 'ethnicity')}
+        empty = None
+        for chunk in chunks:
+            empty = chunk.iloc[:0]
+            # Collect the values on the rows kept at the step each column is encoded in `_process`
+            chunk = self._clean(chunk)
+            vocabularies['actor_gender'].update(MultiHotEncoder().fit(chunk['actor_gender']).vocabulary)
+            chunk = chunk[US_ENGLISH_MOVIES(chunk)]
+            for column_name in ('Movie genres', 'ethnicity'):
+                vocabularies[column_name].update(MultiHotEncoder().fit(chunk[column_name]).vocabulary)
+        self.encoders = {
+            column_name: MultiHotEncoder(vocabulary=sorted(vocabulary))
+            for column_name, vocabulary in vocabularies.items()
+        }
+        self.columns = None if empty is None else self._process(empty, fit=False).columns.tolist()
+        return self
+
+    def _encode(self, df, column_name, fit):
+        """Replace a list column by its dummy variables with the fitted (or newly fitted) encoder"""
+        if fit:
+            self.encoders[column_name] = MultiHotEncoder().fit(df[column_name])
+        return create_dummies_from_list_column(df, column_name, self.encoders[column_name])
+
+    @staticmethod
+    def _clean(df):
+        """Drop the unused columns and the movies with missing data or without revenue"""
+        df = df.drop(["wikipedia_movie_id", "wikidata_movie_id", "Movie name", "character_name", "plot"], axis=1)
+        df = df.dropna()
+        return df[df["Movie box office revenue"] != 0]
+
+    def _process(self, df, fit):
+        if fit:
+            self.encoders = {}
+        df = self._clean(df)
+
+        df = self._encode(df, 'actor_gender', fit)
+        df = df.drop(columns=["actor_gender_"], errors="ignore")
+        df["F ratio"] = df["actor_gender_F"] / (df["actor_gender_M"]+df["actor_gender_F"])
+
+        df = replace_with_min_max(df, 'actor_age_at_release')
+        df = replace_with_min_max(df, 'actor_height_meters')
+
+        df = df[US_ENGLISH_MOVIES(df)]
+
+        df = self._encode(df, 'Movie genres', fit)
+        df = self._encode(df, 'ethnicity', fit)
+
+        df = df.rename(columns=lambda col: col.replace('Movie genres_', '') if col.startswith('Movie genres') else col)
+        df = df.rename(columns=lambda col: col.replace('ethnicity_', '') if col.startswith('ethnicity') else col)
+        df = df.drop(["Movie languages", "Movie countries"], axis=1)
+        df = df.dropna()
+
+        #We compare heights wrt a reference of 160 cm :
+        df['actor_height_meters_min'] = df['actor_height_meters_min'] * 100 - 160
+        df['actor_height_meters_max'] = df['actor_height_meters_max'] * 100 - 160
+
+        df = df.sort_values(by="Movie release date")
+        df['Movie release date'] = df['Movie release date'].astype(int)
+        period_start = df['Movie release date'] // 5 * 5
+        df['period'] = period_start.astype(str) + "-" + (period_start + 4).astype(str)
+        df['ethnic_score'] = df[ETHNICITY_CATEGORIES].sum(axis=1)
+        if fit:
+            self.columns = df.columns.tolist()
+        return df
 
 def preprocess_data_for_model(df):
     """
@@ -357,40 +1052,75 @@ def preprocess_data_for_model(df):
     -------
     Transformed dataframe ready for modeling.
     """
-    df = df.drop(["wikipedia_movie_id", "wikidata_movie_id", "Movie name", "character_name", "plot"], axis=1)
-    df = df.dropna()
-    df = df[df["Movie box office revenue"] != 0]
-    
-    df = create_dummies_from_list_column(df, 'actor_gender')
-    df = df.drop("actor_gender_", axis=1)
-    df["F ratio"] = df["actor_gender_F"] / (df["actor_gender_M"]+df["actor_gender_F"])
-
-    df = replace_with_min_max(df, 'actor_age_at_release')
-    df = replace_with_min_max(df, 'actor_height_meters')
-
-    df_with_countries = create_dummies_from_list_column(df, 'Movie countries')
-    df = df[df_with_countries["Movie countries_United States of America"] == 1]
-
-    df_with_countries = create_dummies_from_list_column(df, 'Movie languages')
-    df = df[df_with_countries["Movie languages_English Language"] == 1]
-
-    df = create_dummies_from_list_column(df, 'Movie genres')
-    df = create_dummies_from_list_column(df, 'ethnicity')
-
-    df = df.rename(columns=lambda col: col.replace('Movie genres_', '') if col.startswith('Movie genres') else col)
-    df = df.rename(columns=lambda col: col.replace('ethnicity_', '') if col.startswith('ethnicity') else col)
-    df = df.drop(["Movie languages", "Movie countries"], axis=1)
-    df.dropna(inplace=True)
-    
-    #We compare heights wrt a reference of 160 cm :
-    df['actor_height_meters_min'] = df['actor_height_meters_min'] * 100 - 160 
-    df['actor_height_meters_max'] = df['actor_height_meters_max'] * 100 - 160
-
-    df = df.sort_values(by="Movie release date")
-    df['Movie release date'] = df['Movie release date'].astype(int)
-    df['period'] = df['Movie release date'].apply(lambda x: f"{x // 5 * 5}-{(x // 5 + 1) * 5 - 1}")
-    df['ethnic_score'] = df[['African Ethnicities', 'American Ethnicities', 'Asian Ethnicities', 'Eastern European Ethnicities', 'Indigenous Peoples',
-    'Jewish Communities', 'Latin American Ethnicities', 'Middle Eastern and Arab Ethnicities',
-    'Northern European Ethnicities', 'Oceanian Ethnicities', 'Southern European Ethnicities',
-   'Western European Ethnicities']].sum(axis=1)
-    return df
+    return ModelPreprocessor().fit_transform(df)
+
+def preprocess_data_for_model_chunked(source, path, chunksize=100_000, preprocessor=None):
+    """
+    Out-of-core `preprocess_data_for_model`, bounding the memory use by the chunk size.
+
+    A first pass over the chunks learns the vocabularies of the dummy variables (unless a fitted
+    `preprocessor` is given), then each chunk is preprocessed on its own and appended to the
+    Parquet file at `path`. Unlike `preprocess_data_for_model`, the rows keep their input order
+    instead of being sorted by release date, which would need all of them at once, and duplicated
+    column names (the dummy variables of empty genres and ethnicities) are made unique as "",
+    ".1", ... like `pd.read_csv` does.
+
+    Parameters:
+    ----------
+    source : DataFrame or path to a Parquet file of movies with characters, read in chunks.
+    path : Path of the Parquet file to write.
+    chunksize : Number of input rows per chunk.
+    preprocessor : Fitted `ModelPreprocessor` to use instead of fitting one on the source.
+
+    Returns:
+    -------
+    The preprocessor used.
+    """
+    import pyarrow.parquet as pq
+
+    def chunks():
+        if isinstance(source, pd.DataFrame):
+            for start in range(0, len(source), chunksize):
+                yield source.iloc[start:start + chunksize]
+        else:
+            start = 0
+            for batch in pq.ParquetFile(source).iter_batches(batch_size=chunksize):
+                chunk = batch.to_pandas()
+                # Files without an index column get the positions of the rows as index
+                if isinstance(chunk.index, pd.RangeIndex):
+                    chunk.index = pd.RangeIndex(start, start + len(chunk))
+                start += len(chunk)
+                yield chunk
+
+    preprocessor = preprocessor or ModelPreprocessor().fit_chunks(chunks())
+    columns = pd.Series(preprocessor.columns)
+    for name in columns[columns.duplicated()].unique():
+        duplicates = columns == name
+        columns[duplicates] = [name] + [f"{name}.{i}" for i in range(1, duplicates.sum())]
+
+    writer = None
+    empty = None
+    try:
+        for chunk in chunks():
+            df = preprocessor.transform(chunk).set_axis(columns.tolist(), axis=1)
+            if writer is None:
+                # The columns of an empty chunk (e.g. only non-US movies) have no values to infer
+                # their types from, so the schema is taken from the first non-empty chunk
+                if df.empty:
+                    empty = df
+                    continue
+                table = pa.Table.from_pandas(df)
+                writer = pq.ParquetWriter(path, table.schema)
+            else:
+                table = pa.Table.from_pandas(df, schema=writer.schema)
+            writer.write_table(table)
+        if writer is None and empty is not None:
+            schema = pa.Schema.from_pandas(empty)
+            schema = pa.schema(
+                field.with_type(pa.string()) if field.type == pa.null() else field for field in schema
+            ).with_metadata(schema.metadata)
+            pq.write_table(pa.Table.from_pandas(empty, schema=schema), path)
+    finally:
+        if writer is not None:
+            writer.close()
+    return preprocessor
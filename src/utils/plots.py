@@ -7,6 +7,8 @@ import plotly.io as pio
 import plotly.tools as tls
 import seaborn as sns
 
+from src.utils.bitmap_index import BitmapIndex, has
+
 
 # List of LGBTQ+ related terms
 lgbtq_terms = [
@@ -799,14 +801,15 @@ def plot_female_ratio_heatmap(df):
         "2010-2014",
     ]
 
+    # Index the periods and genres once instead of filtering the frame for each cell
+    index = BitmapIndex(df, value_columns=["period"] + genres)
     heatmap_data = []
 
     # For each period and genre, we calculate average F ratio for movies of that genre
     for period in periods_of_interest:
-        period_data = df[df["period"] == period]
         row_data = []
         for genre in genres:
-            genre_movies = period_data[period_data[genre] == 1]
+            genre_movies = df.iloc[index.positions(has("period", period) & has(genre))]
             if len(genre_movies) > 0:
                 f_ratio = genre_movies["F ratio"].mean() * 100
                 row_data.append(f_ratio)
@@ -868,14 +871,15 @@ def plot_male_ratio_heatmap(df):
         "2010-2014",
     ]
 
+    # Index the periods and genres once instead of filtering the frame for each cell
+    index = BitmapIndex(df, value_columns=["period"] + genres)
     heatmap_data = []
 
     # For each period and genre, calculate average male proportion (1 - F ratio) for movies of that genre
     for period in periods_of_interest:
-        period_data = df[df["period"] == period]
         row_data = []
         for genre in genres:
-            genre_movies = period_data[period_data[genre] == 1]
+            genre_movies = df.iloc[index.positions(has("period", period) & has(genre))]
             if len(genre_movies) > 0:
                 m_ratio = (1 - genre_movies["F ratio"]).mean() * 100
                 row_data.append(m_ratio)
@@ -936,14 +940,15 @@ def plot_ethnic_score_heatmap(df):
         "2010-2014",
     ]
 
+    # Index the periods and genres once instead of filtering the frame for each cell
+    index = BitmapIndex(df, value_columns=["period"] + genres)
     heatmap_data = []
 
     # For each period and genre, calculate average ethnic_score for movies of that genre
     for period in periods_of_interest:
-        period_data = df[df["period"] == period]
         row_data = []
         for genre in genres:
-            genre_movies = period_data[period_data[genre] == 1]
+            genre_movies = df.iloc[index.positions(has("period", period) & has(genre))]
             if len(genre_movies) > 0:
                 avg_score = genre_movies["ethnic_score"].mean()
                 row_data.append(avg_score)
@@ -0,0 +1,153 @@
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.dataloader import DataLoader
+from src.utils.data_utils import decode_json_dict_column, join_ragged
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_cached_table_is_read_without_its_sources(tmp_path, monkeypatch, workers):
+    loader = DataLoader(cache_dir=str(tmp_path / "cache"), workers=workers)
+    # Only the fingerprints of the sources are needed when the table is cached
+    for source in loader.paths:
+        loader.paths[source] = str(tmp_path / source)
+        (tmp_path / source).write_text("")
+    cached = pd.DataFrame({"wikipedia_movie_id": [1, 2], "Movie name": ["A", "B"]})
+    (tmp_path / "cache").mkdir()
+    cached.to_parquet(loader._cache_path("movies_with_characters"))
+
+    def read_csv(*args, **kwargs):
+        raise AssertionError("a source file was parsed")
+
+    monkeypatch.setattr(DataLoader, "_read_csv", read_csv)
+    pd.testing.assert_frame_equal(loader.load_movies_with_characters(), cached)
+
+
+def test_tmdb_title_fallback_is_limited_to_undated_movies():
+    movies = pd.DataFrame({
+        "Movie name": ["The Thing", "Psycho", "Vertigo"],
+        "Movie release date": ["1982-06-25", None, "1958"],
+    })
+    tmdb = pd.DataFrame({
+        "title": ["The Thing", "Psycho", "Vertigo", "Vertigo"],
+        "release_date": ["2011", "1960", "1958", "2024"],
+    })
+    matches, stats = DataLoader._match_tmdb(movies, tmdb)
+    # The 2011 remake is not matched with the 1982 movie
+    assert matches.tolist() == [-1, 1, 2]
+    assert stats == {"matched": 2, "ambiguous": 1}
+
+
+def test_tmdb_matches_are_read_from_the_cache(tmp_path):
+    loader = DataLoader(cache_dir=str(tmp_path / "cache"))
+    for source in loader.paths:
+        loader.paths[source] = str(tmp_path / source)
+        (tmp_path / source).write_text("")
+    cached = pd.DataFrame({"Movie name": ["A"], "Movie release date": ["2000"]})
+    cached.attrs["tmdb_matches"] = {"matched": 1, "ambiguous": 0}
+    (tmp_path / "cache").mkdir()
+    cached.to_parquet(loader._cache_path("movies"))
+
+    assert loader.tmdb_matches is None
+    loader.load("movies")
+    assert loader.tmdb_matches == {"matched": 1, "ambiguous": 0}
+
+
+@pytest.mark.parametrize("strings", [
+    [json.dumps({"/m/1": "English Language", "/m/2": "Français"}), "{}", None, json.dumps({"/m/3": "x\\", "/m/4": "a, b"})],
+    # Escaped quotes
+    [json.dumps({"/m/1": "English Language"}), None, json.dumps({"/m/2": 'The "Silent" Language'})],
+    # Other spacing, mixed with rows of the usual framing
+    ['{"/m/1":"A","/m/2":"B"}', '{ "/m/3": "Drama" }', '{"/m/4": "C"}', '{"/m/5": "D","/m/6": "E"}', "{ }", "{}"],
+])
+def test_decode_json_dict_column(strings):
+    keys, values, offsets = decode_json_dict_column(pd.Series(strings))
+    rows = [json.loads(string or "{}") for string in strings]
+    assert offsets.tolist() == [0] + pd.Series([len(row) for row in rows]).cumsum().tolist()
+    assert keys.tolist() == [key for row in rows for key in row]
+    assert values.tolist() == [value for row in rows for value in row.values()]
+    assert join_ragged(values, offsets).tolist() == [", ".join(row.values()) for row in rows]
+
+
+@pytest.mark.parametrize("engine", [None, "pyarrow"])
+def test_tmdb_short_rows_are_padded_with_any_engine(tmp_path, engine):
+    path = tmp_path / "movies_metadata.csv"
+    path.write_text(
+        "adult,title,release_date,revenue\n"
+        "False,Heat,1995-12-15,187436818\n"
+        "False,Short row\n"
+        "False,Toy Story,1995-10-30,373554033\n"
+    )
+    loader = DataLoader(engine=engine, workers=4)
+    loader.paths["tmdb_movies"] = str(path)
+    expected = pd.DataFrame({
+        "title": ["Heat", "Short row", "Toy Story"],
+        "release_date": ["1995", np.nan, "1995"],
+        "revenue": [187436818.0, np.nan, 373554033.0],
+    })
+    pd.testing.assert_frame_equal(loader.load_tmdb_movies(), expected)
+
+
+@pytest.mark.parametrize("workers", [None, 4])
+def test_sources_are_hashed_once(tmp_path, monkeypatch, workers):
+    loader = DataLoader(cache_dir=str(tmp_path / "cache"), hash_sources=True, workers=workers)
+    for source in loader.paths:
+        loader.paths[source] = str(tmp_path / source)
+        (tmp_path / source).write_text("")
+    (tmp_path / "cache").mkdir()
+    pd.DataFrame({"wikipedia_movie_id": [1]}).to_parquet(loader._cache_path("movies_with_characters"))
+
+    hashed = []
+    sha256 = hashlib.sha256
+
+    def count_sha256(*args):
+        hashed.append(args)
+        return sha256(*args)
+
+    monkeypatch.setattr(hashlib, "sha256", count_sha256)
+    loader = DataLoader(cache_dir=str(tmp_path / "cache"), hash_sources=True, workers=workers)
+    loader.paths = {source: str(tmp_path / source) for source in loader.paths}
+    loader.load_movies_with_characters()
+    # The content of each source file and loader source is hashed once, the cache keys are
+    # hashed from their arguments
+    files = [loader.paths[source] for source in loader.sources("movies_with_characters")]
+    assert len([args for args in hashed if not args]) == len(files) + 2
+
+
+def test_duplicated_freebase_ids_repeat_their_characters():
+    characters = pd.DataFrame({
+        "Wikipedia movie ID": [1, 1, 2],
+        "Freebase movie ID": ["/m/m1", "/m/m1", "/m/m2"],
+        "Character name": ["A", "B", "C"],
+        "Actor date of birth": ["1950", "1960", None],
+        "Actor gender": ["F", "M", "F"],
+        "Actor height (in meters)": [1.7, 1.8, np.nan],
+        "Actor ethnicity (Freebase ID)": ["/m/e1", "/m/e2", None],
+        "Actor name": ["a", "b", "c"],
+        "Actor age at movie release": [30.0, 20.0, np.nan],
+        "Freebase character ID": ["/m/c1", "/m/c2", "/m/c3"],
+        "Freebase actor ID": ["/m/a1", "/m/a2", "/m/a3"],
+    })
+    movies = pd.DataFrame({"wikipedia_movie_id": [1, 2], "Movie release date": ["1980", "1990"]})
+    fb_wiki = pd.DataFrame({
+        "freebase_id": ["/m/e1", "/m/e2", "/m/c1", "/m/a1", "/m/m1", "/m/m2"],
+        "wikidata_id": ["Q1", "Q2", "Q3", "Q4", "Q5", "Q6"],
+        "label": ["Irish", "Swedes", "A", "a", "M1", "M2"],
+    })
+    loader = DataLoader()
+
+    # The lookup in the index of unique IDs gives the same table as the merges
+    unique = loader._clean_characters(characters, fb_wiki.set_index("freebase_id"), movies)
+    unused = pd.DataFrame({"freebase_id": ["/m/x", "/m/x"], "wikidata_id": ["Q8", "Q9"], "label": ["X", "Y"]})
+    merged = loader._clean_characters(characters, pd.concat([fb_wiki, unused]).set_index("freebase_id"), movies)
+    pd.testing.assert_frame_equal(merged, unique)
+    assert unique["ethnicity"].tolist() == ["Irish", "Swedes", np.nan]
+
+    duplicated = pd.concat([fb_wiki, pd.DataFrame({"freebase_id": ["/m/e1"], "wikidata_id": ["Q7"], "label": ["Scottish"]})])
+    result = loader._clean_characters(characters, duplicated.set_index("freebase_id"), movies)
+    assert result["character_name"].tolist() == ["A", "A", "B", "C"]
+    assert result["ethnicity"].tolist() == ["Irish", "Scottish", "Swedes", np.nan]
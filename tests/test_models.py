@@ -0,0 +1,193 @@
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.api as sm
+from sklearn.linear_model import LogisticRegression, Ridge
+from sklearn.metrics import f1_score
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import StandardScaler
+
+from src.models import logistic, ridge
+from src.models.ridge import ETHNICITY_COLUMNS
+
+GENRES = ["Action", "Comedy", "Drama", "Horror", "Romance"]
+TARGET_COLUMNS = ["Movie box office revenue", "period", "Movie release date"]
+
+
+def make_model_data(seed=0):
+    """
+    Synthetic output of `preprocess_data_for_model`: three periods with more than 500 movies and
+    a smaller one, and an `ethnic_score` collinear with the ethnicity columns
+    """
+    rng = np.random.default_rng(seed)
+    frames = []
+    for start, n in [(1980, 620), (1985, 300), (1990, 700), (1995, 560)]:
+        df = pd.DataFrame({
+            "Movie release date": rng.integers(start, start + 5, n),
+            "actor_gender_F": rng.integers(0, 5, n),
+            "actor_gender_M": rng.integers(0, 8, n),
+            "actor_age_at_release_min": rng.normal(25, 5, n),
+            "actor_height_meters_max": rng.normal(1.8, 0.07, n),
+        })
+        df["F ratio"] = df["actor_gender_F"] / (df["actor_gender_F"] + df["actor_gender_M"]).clip(lower=1)
+        for genre in GENRES:
+            df[genre] = (rng.random(n) < 0.3).astype(int)
+        for ethnicity in ETHNICITY_COLUMNS:
+            df[ethnicity] = (rng.random(n) < 0.15).astype(int)
+        df["ethnic_score"] = df[ETHNICITY_COLUMNS].sum(axis=1)
+        signal = 0.8 * df["Action"] - 0.5 * df["Drama"] + 0.1 * df["actor_gender_M"] + 0.3 * df["Asian Ethnicities"]
+        df["Movie box office revenue"] = np.exp(18 + signal + rng.normal(0, 1.2, n))
+        df["period"] = f"{start}-{start + 4}"
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.fixture(scope="module")
+def data():
+    return make_model_data()
+
+
+def scaled_period(df, period, drop_columns=()):
+    """Scaled train features and revenue of a period, as split by `prepare_period`"""
+    period_data = df[df["period"] == period]
+    X = period_data.drop(TARGET_COLUMNS + list(drop_columns), axis=1)
+    y = period_data["Movie box office revenue"]
+    xtrain, xtest, ytrain, ytest = train_test_split(X, y, test_size=0.1, random_state=42, shuffle=True)
+    x_scaler = StandardScaler().fit(xtrain)
+    return x_scaler.transform(xtrain), StandardScaler().fit_transform(ytrain.values.reshape(-1, 1)).ravel(), x_scaler.transform(xtest), ytest
+
+
+def assert_same_features(expected, result, rtol=1e-7):
+    assert list(expected) == list(result)
+    for period in expected:
+        a, b = expected[period], result[period]
+        assert list(a["Feature"]) == list(b["Feature"]), period
+        np.testing.assert_allclose(a["Coefficient"], b["Coefficient"], rtol=rtol)
+        np.testing.assert_allclose(a["P-value"], b["P-value"], rtol=1e-6, atol=1e-12)
+
+
+@pytest.mark.parametrize("drop_columns", [["ethnic_score"], ETHNICITY_COLUMNS])
+def test_fit_ridge_ols_matches_sklearn_and_statsmodels(data, drop_columns):
+    for period in ridge.valid_periods(data).index:
+        xtrain, ytrain, _, _ = scaled_period(data, period, drop_columns)
+        fit = ridge.fit_ridge_ols(xtrain, ytrain)
+
+        model = Ridge(alpha=100.0).fit(xtrain, ytrain)
+        np.testing.assert_allclose(fit["coef"], model.coef_, atol=1e-10)
+        assert fit["intercept"] == pytest.approx(model.intercept_, abs=1e-10)
+
+        ols = sm.OLS(ytrain, sm.add_constant(xtrain, has_constant="add")).fit()
+        np.testing.assert_allclose(fit["params"], ols.params, atol=1e-9)
+        np.testing.assert_allclose(fit["pvalues"], ols.pvalues, atol=1e-9)
+        assert fit["rsquared"] == pytest.approx(ols.rsquared, abs=1e-10)
+        assert fit["df_resid"] == ols.df_resid
+
+
+@pytest.mark.parametrize("fit", [
+    ridge.ridge_regression_characters, ridge.ridge_regression_characters_general, logistic.logistic_regression,
+])
+def test_parallel_periods_are_identical(data, fit):
+    expected = fit(data)
+    result = fit(data, n_jobs=2)
+    assert list(expected) == list(result)
+    for period in expected:
+        pd.testing.assert_frame_equal(expected[period], result[period], check_exact=True)
+
+
+def test_ridge_path_matches_sklearn_and_hat_matrix(data):
+    xtrain, ytrain, _, _ = scaled_period(data, "1980-1984", ["ethnic_score"])
+    fit = ridge.ridge_path(xtrain, ytrain)
+    n, p = xtrain.shape
+    with_intercept = np.column_stack([np.ones(n), xtrain])
+    for i in range(0, len(ridge.RIDGE_ALPHAS), 11):
+        alpha = ridge.RIDGE_ALPHAS[i]
+        model = Ridge(alpha=alpha).fit(xtrain, ytrain)
+        np.testing.assert_allclose(fit["coefs"][i], model.coef_, atol=1e-9)
+        assert fit["intercepts"][i] == pytest.approx(model.intercept_, abs=1e-9)
+
+        penalty = alpha * np.eye(p + 1)
+        penalty[0, 0] = 0
+        hat = with_intercept @ np.linalg.solve(with_intercept.T @ with_intercept + penalty, with_intercept.T)
+        residuals = ytrain - hat @ ytrain
+        assert fit["path"]["df"][i] == pytest.approx(np.trace(hat) - 1, rel=1e-9)
+        assert fit["path"]["gcv"][i] == pytest.approx(n * residuals @ residuals / (n - np.trace(hat)) ** 2, rel=1e-9)
+
+
+@pytest.mark.parametrize("fit", [ridge.ridge_regression_characters, ridge.ridge_regression_characters_general])
+def test_grouped_ridge_matches_serial(data, fit):
+    assert_same_features(fit(data), fit(data, grouped=True))
+
+
+def test_grouped_gcv_matches_serial(data):
+    df = data.drop(columns=["ethnic_score"])
+    periods = ridge.valid_periods(df).index
+    expected = [ridge.fit_period(df[df["period"] == period], alpha="gcv") for period in periods]
+    result = ridge.fit_periods_grouped(df, periods, alpha="gcv")
+    for a, b in zip(expected, result):
+        assert a["alpha"] == b["alpha"]
+        assert a["rsquared"] == pytest.approx(b["rsquared"], abs=1e-10)
+        np.testing.assert_allclose(a["ypred"], b["ypred"], rtol=1e-8)
+        pd.testing.assert_index_equal(a["ytest"].index, b["ytest"].index)
+    assert_same_features(
+        ridge.ridge_regression_by_period(df, alpha="gcv"), ridge.ridge_regression_by_period(df, alpha="gcv", grouped=True)
+    )
+
+
+def test_grouped_logistic_matches_serial(data):
+    periods = ridge.valid_periods(data).index
+    result = logistic.fit_periods_grouped(data, periods)
+    for period, fit in zip(periods, result):
+        period_data = data[data["period"] == period]
+        expected = logistic.fit_period(period_data)["features"]
+        features = fit["features"]
+        pd.testing.assert_index_equal(expected.index, features.index)
+        assert list(expected["Feature"]) == list(features["Feature"])
+        # The collinear features are not identified and get NaN p-values
+        identified = features["P-value"].notna()
+        assert set(features["Feature"][~identified]) == set(ETHNICITY_COLUMNS + ["ethnic_score"])
+        np.testing.assert_allclose(expected["P-value"][identified], features["P-value"][identified], atol=1e-6)
+        np.testing.assert_array_equal(expected["P-value"][identified] < 0.05, features["P-value"][identified] < 0.05)
+
+        # The classifier is converged where sklearn's lbfgs stops at its tolerance
+        xtrain, _, xtest, ytest = scaled_period(data, period)
+        ytrain = period_data["Movie box office revenue"].loc[
+            train_test_split(period_data, test_size=0.1, random_state=42, shuffle=True)[0].index
+        ] > 300000000
+        model = LogisticRegression(tol=1e-12, max_iter=10000).fit(xtrain, ytrain)
+        assert fit["f1"] == pytest.approx(f1_score(ytest > 300000000, model.predict(xtest)), abs=1e-12)
+
+
+@pytest.mark.parametrize("window, step", [(5, 1), (10, 3)])
+def test_rolling_windows_match_direct_fits(data, window, step):
+    df = data.drop(columns=["ethnic_score"])
+    features, coefficients = ridge.rolling_ridge_regression(df, window, step)
+    assert len(coefficients) > 0
+    for label in coefficients.index:
+        first, last = map(int, label.split("-"))
+        assert last - first + 1 == window
+        window_data = df[df["Movie release date"].between(first, last)]
+        assert len(window_data) > 500
+        X = window_data.drop(TARGET_COLUMNS, axis=1)
+        y_scaler = StandardScaler()
+        y = y_scaler.fit_transform(window_data[["Movie box office revenue"]]).ravel()
+        fit = ridge.fit_ridge_ols(StandardScaler().fit_transform(X), y)
+        np.testing.assert_allclose(coefficients.loc[label], fit["coef"], atol=1e-9)
+
+        expected = ridge.significant_coefficients(
+            ["const"] + list(X.columns), fit["params"], fit["pvalues"], y_scaler.mean_[0], y_scaler.scale_[0]
+        )
+        assert list(expected["Feature"]) == list(features[label]["Feature"])
+        np.testing.assert_allclose(expected["Coefficient"], features[label]["Coefficient"], rtol=1e-7)
+        np.testing.assert_allclose(expected["P-value"], features[label]["P-value"], atol=1e-9)
+
+
+def test_grouped_ridge_with_an_alpha_per_period(data):
+    df = data.drop(columns=["ethnic_score"])
+    periods = ridge.valid_periods(df).index
+    alphas = np.array([1.0, 10.0, 100.0])
+    result = ridge.fit_periods_grouped(df, periods, alpha=alphas)
+    for period, alpha, fit in zip(periods, alphas, result):
+        expected = ridge.fit_period(df[df["period"] == period], alpha=alpha)
+        assert fit["alpha"] == alpha
+        np.testing.assert_allclose(fit["ypred"], expected["ypred"], rtol=1e-8)
+        assert_same_features({period: expected["features"]}, {period: fit["features"]})
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+from src.utils.data_utils import ETHNICITY_CATEGORIES, preprocess_data_for_model, preprocess_data_for_model_chunked
+
+GENRES = ["Action", "Comedy", "Drama", "Horror", "Romance"]
+COUNTRIES = ["United States of America", "France", "India"]
+LANGUAGES = ["English Language", "French Language", "Hindi Language"]
+
+
+def make_movies(n=400, seed=0):
+    """Synthetic movies with characters, with the columns of `DataLoader.load_movies_with_characters`"""
+    rng = np.random.default_rng(seed)
+
+    def pick(values, low, high):
+        return ", ".join(rng.choice(values, rng.integers(low, high + 1), replace=False))
+
+    rows = []
+    for i in range(n):
+        n_actors = rng.integers(1, 4)
+        rows.append({
+            "wikipedia_movie_id": i,
+            "wikidata_movie_id": f"Q{i}",
+            "Movie name": f"Movie {i}",
+            "Movie release date": str(rng.integers(1950, 2010)),
+            "Movie box office revenue": float(rng.integers(10 ** 5, 10 ** 9)),
+            "Movie languages": pick(LANGUAGES, 1, 2) if rng.random() < 0.3 else "English Language",
+            "Movie countries": pick(COUNTRIES, 1, 2) if rng.random() < 0.3 else "United States of America",
+            "character_name": ", ".join(f"Character {i}.{j}" for j in range(n_actors)),
+            "actor_gender": ", ".join(rng.choice(["M", "F"], n_actors)),
+            "actor_height_meters": ", ".join(f"{rng.uniform(1.5, 2.0):.3f}" for _ in range(n_actors)),
+            "actor_age_at_release": ", ".join(f"{rng.integers(18, 80)}.0" for _ in range(n_actors)),
+            "plot": f"Plot {i}",
+            "Movie genres": pick(GENRES, 1, 3),
+            "ethnicity": pick(ETHNICITY_CATEGORIES, 1, 3),
+        })
+    return pd.DataFrame(rows)
+
+
+def test_chunked_preprocessing_with_empty_first_chunk(tmp_path):
+    movies = make_movies()
+    # The first chunks only have movies filtered out by the preprocessing
+    us = movies["Movie countries"].str.contains("United States of America")
+    movies = pd.concat([movies[~us], movies[us]])
+    assert (~us).sum() > 40
+
+    path = tmp_path / "model.parquet"
+    preprocess_data_for_model_chunked(movies, path, chunksize=20)
+
+    expected = preprocess_data_for_model(movies)
+    result = pd.read_parquet(path)
+    # Duplicated names of the dummy variables are made unique in the file
+    assert result.columns.is_unique and len(result.columns) == len(expected.columns)
+    pd.testing.assert_frame_equal(
+        result.set_axis(expected.columns, axis=1).sort_index(), expected.sort_index(), check_dtype=False
+    )
+
+
+def test_chunked_preprocessing_without_kept_rows(tmp_path):
+    movies = make_movies()
+    us = movies["Movie countries"].str.contains("United States of America")
+    preprocessor = preprocess_data_for_model_chunked(movies, tmp_path / "all.parquet", chunksize=50)
+
+    path = tmp_path / "empty.parquet"
+    preprocess_data_for_model_chunked(movies[~us], path, chunksize=20, preprocessor=preprocessor)
+    result = pd.read_parquet(path)
+    assert result.empty
+    assert list(result.columns) == list(pd.read_parquet(tmp_path / "all.parquet").columns)
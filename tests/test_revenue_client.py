@@ -0,0 +1,157 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from src.utils.data_utils import RevenueCache, WikidataRevenueClient
+
+
+class Wikidata(BaseHTTPRequestHandler):
+    """
+    Stub of the wbgetentities API, where the revenue of item Qn is n and the `without_revenue`
+    items have none. A request with an `unknown` id fails as a whole, as on Wikidata. It answers after `delay` seconds, recording the requested ids and the
+    requests in flight, and cuts the responses to the `truncated` ids in the middle of their body.
+    """
+    lock = threading.Lock()
+    delay = 0
+    truncated = set()
+    without_revenue = set()
+    unknown = set()
+    requested = []
+    in_flight = 0
+    max_in_flight = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        time.sleep(cls.delay)
+        ids = parse_qs(urlparse(self.path).query)["ids"][0].split("|")
+        with cls.lock:
+            cls.requested.extend(ids)
+        entities = {
+            wikidata_id: {"id": wikidata_id, "claims": {} if wikidata_id in cls.without_revenue else {"P2142": [
+                {"mainsnak": {"datavalue": {"value": {"amount": "+" + wikidata_id[1:]}}}}
+            ]}}
+            for wikidata_id in ids
+        }
+        if cls.unknown.intersection(ids):
+            body = json.dumps({"error": {"code": "no-such-entity"}}).encode()
+        else:
+            body = json.dumps({"entities": entities}).encode()
+        with cls.lock:
+            cls.in_flight -= 1
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if cls.truncated.intersection(ids):
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+
+class Server(ThreadingHTTPServer):
+    request_queue_size = 64
+
+
+@pytest.fixture
+def server_url():
+    server = Server(("127.0.0.1", 0), Wikidata)
+    Wikidata.delay = 0
+    Wikidata.truncated = set()
+    Wikidata.without_revenue = set()
+    Wikidata.unknown = set()
+    Wikidata.requested = []
+    Wikidata.max_in_flight = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/w/api.php"
+    server.shutdown()
+
+
+def test_async_requests_are_bounded_by_concurrency(server_url):
+    Wikidata.delay = 0.2
+    client = WikidataRevenueClient(server_url, batch_size=1, max_requests_per_second=None)
+    ids = [f"Q{i}" for i in range(1, 41)]
+    revenues = asyncio.run(client.get_revenues_async(ids, concurrency=16))
+
+    assert revenues == {wikidata_id: float(wikidata_id[1:]) for wikidata_id in ids}
+    # Bounded by `concurrency`, not by the threads of the default executor of the loop
+    assert 8 < Wikidata.max_in_flight <= 16
+    assert client.session.get_adapter(server_url)._pool_maxsize >= 16
+
+
+def get_revenues(client, ids, asynchronous):
+    if asynchronous:
+        return asyncio.run(client.get_revenues_async(ids, backoff=0))
+    return client.get_revenues(ids)
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_truncated_response_fails_its_batch(server_url, asynchronous):
+    Wikidata.truncated = {"Q3"}
+    client = WikidataRevenueClient(server_url, batch_size=2, max_requests_per_second=None)
+    revenues = get_revenues(client, [f"Q{i}" for i in range(1, 7)], asynchronous)
+
+    assert revenues == {"Q1": 1.0, "Q2": 2.0, "Q3": None, "Q4": None, "Q5": 5.0, "Q6": 6.0}
+    assert sorted(client.failed_ids) == ["Q3", "Q4"]
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_batch_with_an_unknown_id_is_retried_id_by_id(server_url, asynchronous):
+    Wikidata.unknown = {"Q3"}
+    client = WikidataRevenueClient(server_url, batch_size=4, max_requests_per_second=None)
+    ids = ["Q1", "Q2", "Q3", "Q4", "Q5", "Q6", "P7"]
+    revenues = get_revenues(client, ids, asynchronous)
+
+    # The ids that are not item ids are not requested
+    assert revenues == {"Q1": 1.0, "Q2": 2.0, "Q3": None, "Q4": 4.0, "Q5": 5.0, "Q6": 6.0, "P7": None}
+    assert client.failed_ids == []
+    # The first batch is requested once whole, then id by id
+    assert sorted(Wikidata.requested) == ["Q1", "Q1", "Q2", "Q2", "Q3", "Q3", "Q4", "Q4", "Q5", "Q6"]
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_cached_revenues_are_not_requested_again(server_url, tmp_path, asynchronous):
+    Wikidata.without_revenue = {"Q2"}
+    Wikidata.truncated = {"Q5"}
+    path = str(tmp_path / "revenues.sqlite")
+    client = WikidataRevenueClient(server_url, batch_size=2, max_requests_per_second=None, cache=RevenueCache(path))
+    ids = [f"Q{i}" for i in range(1, 7)]
+    revenues = get_revenues(client, ids, asynchronous)
+    client.cache.close()
+
+    assert revenues == {"Q1": 1.0, "Q2": None, "Q3": 3.0, "Q4": 4.0, "Q5": None, "Q6": None}
+    # The ids without a revenue are stored, the ids of the failed batch are not
+    cache = RevenueCache(path)
+    assert cache.get(ids) == {"Q1": 1.0, "Q2": None, "Q3": 3.0, "Q4": 4.0}
+
+    # A rerun only requests the failed ids
+    Wikidata.truncated = set()
+    Wikidata.requested = []
+    client = WikidataRevenueClient(server_url, batch_size=2, max_requests_per_second=None, cache=cache)
+    revenues = get_revenues(client, ids, asynchronous)
+    assert sorted(Wikidata.requested) == ["Q5", "Q6"]
+    assert revenues == {wikidata_id: None if wikidata_id == "Q2" else float(wikidata_id[1:]) for wikidata_id in ids}
+    assert cache.get(ids) == revenues
+
+
+def test_cached_revenues_expire(tmp_path, monkeypatch):
+    path = str(tmp_path / "revenues.sqlite")
+    cache = RevenueCache(path, ttl=3600)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now - 7200)
+    cache.put({"Q1": 1.0, "Q2": None})
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache.put({"Q3": 3.0, "Q4": None})
+
+    assert cache.get(["Q1", "Q2", "Q3", "Q4", "Q5"]) == {"Q3": 3.0, "Q4": None}
+    assert RevenueCache(path).get(["Q1", "Q2", "Q3", "Q4", "Q5"]) == {"Q1": 1.0, "Q2": None, "Q3": 3.0, "Q4": None}